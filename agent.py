@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+encoDHer - a python package for symmetric encryption of email
+using the Diffie-Hellman shared secret key protocol.
+
+Copyright (C) 2013 by David R. Andersen
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, see https://github.com/rxcomm/encoDHer
+
+The encodher agent unlocks keys.db once and serves KeyStore operations
+over a unix socket, so encodher commands don't need the keys.db
+passphrase or a gpg decrypt while it is running.  Each request is a
+single line of JSON, {"op": name, "args": [...]}, answered with
+{"result": ...} or {"error": name, "message": ...}.
+"""
+import os
+import sys
+import json
+import socket
+from constants import *
+
+_client = None
+
+class AgentError(Exception):
+    pass
+
+class AgentClient(object):
+    """
+    The client side of the agent.  It exposes the same methods as
+    dhutils.KeyStore.
+    """
+
+    def __init__(self, socketPath=AGENT_SOCKET):
+        self.socketPath = socketPath
+
+    def call(self, op, *args):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.socketPath)
+            s.sendall(json.dumps({'op': op, 'args': args})+'\n')
+            reply = readLine(s)
+        finally:
+            s.close()
+        if not reply:
+            raise AgentError('no reply from encodher agent')
+        reply = json.loads(reply)
+        if 'error' in reply:
+            import dhutils
+            if reply['error'] == 'RouteExists':
+                raise dhutils.RouteExists(*reply['message'])
+            raise AgentError(reply['message'])
+        return reply['result']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    # the agent saves as it goes and always has the current routes, so
+    # a long-running command can treat it like a dhutils.Session
+    def save(self):
+        pass
+
+    def refresh(self):
+        return True
+
+    def ping(self):
+        return self.call('ping')
+
+    def stop(self):
+        return self.call('stop')
+
+    def __getattr__(self, op):
+        import dhutils
+        if op not in dhutils.KeyStore.readOps+dhutils.KeyStore.writeOps:
+            raise AttributeError(op)
+        return lambda *args: self.call(op, *args)
+
+def readLine(s):
+    data = ''
+    while not data.endswith('\n'):
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def connect(socketPath=AGENT_SOCKET):
+    """
+    Return an AgentClient if an agent is answering on socketPath,
+    otherwise None.  The answer is remembered for the rest of the process.
+    """
+
+    global _client
+    if _client is None:
+        _client = False
+        if os.path.exists(socketPath):
+            client = AgentClient(socketPath)
+            try:
+                client.ping()
+                _client = client
+            except (socket.error, AgentError, ValueError):
+                pass
+    return _client or None
+
+def serve(gpg, dbpassphrase, socketPath=AGENT_SOCKET, idleTimeout=AGENT_TIMEOUT,
+          detach=False):
+    """
+    Unlock keys.db and answer KeyStore requests on socketPath until we
+    are told to stop or nothing has been asked for idleTimeout seconds.
+    Changes are saved with closeDB after every write, and once more on
+    the way out.  An operation that fails is rolled back and its error
+    sent to the client; a write that can't be saved is reported as a
+    SaveError.  Either way the agent keeps serving.  With detach, the
+    agent goes into the background once keys.db is unlocked and the
+    socket is ready.
+    """
+
+    import dhutils
+    db = dhutils.openDB(KEYS_DB,gpg,dbpassphrase)
+    store = dhutils.KeyStore(db)
+    ops = dhutils.KeyStore.readOps+dhutils.KeyStore.writeOps
+
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0177)
+    try:
+        server.bind(socketPath)
+    finally:
+        os.umask(umask)
+    server.listen(5)
+    server.settimeout(idleTimeout)
+    if detach:
+        print 'encodher agent listening on '+socketPath
+        sys.stdout.flush()
+        daemonize()
+
+    try:
+        while True:
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                break
+            conn.settimeout(30)
+            try:
+                request = json.loads(readLine(conn))
+                op = request['op']
+                if op == 'stop':
+                    conn.sendall(json.dumps({'result': True})+'\n')
+                    break
+                elif op == 'ping':
+                    reply = {'result': True}
+                elif op in ops:
+                    args = request['args']
+                    try:
+                        reply = {'result': getattr(store, op)(*args)}
+                    except dhutils.RouteExists as e:
+                        reply = {'error': 'RouteExists', 'message': e.args}
+                    except Exception as e:
+                        # a failed operation is the caller's problem, not
+                        # the agent's: undo what it left behind and go on
+                        db.rollback()
+                        reply = {'error': e.__class__.__name__,
+                                 'message': str(e) or e.__class__.__name__}
+                    if op in dhutils.KeyStore.writeOps:
+                        # closeDB exits when gpg fails.  The operation has
+                        # happened either way and is saved with the next
+                        # write or on the way out, so report the save alone.
+                        try:
+                            dhutils.closeDB(db,KEYS_DB,gpg,dbpassphrase)
+                        except (Exception, SystemExit):
+                            if 'error' not in reply:
+                                reply = {'error': 'SaveError',
+                                         'message': 'keys.db could not be saved'}
+                else:
+                    reply = {'error': 'AgentError', 'message': 'unknown operation: %s' % op}
+                conn.sendall(json.dumps(reply)+'\n')
+            except socket.error:
+                pass
+            except Exception as e:
+                # a malformed request; tell the client rather than hang up
+                try:
+                    conn.sendall(json.dumps({'error': 'AgentError', 'message':
+                        'bad request: %s' % (str(e) or e.__class__.__name__)})+'\n')
+                except socket.error:
+                    pass
+            finally:
+                conn.close()
+    finally:
+        dhutils.closeDB(db,KEYS_DB,gpg,dbpassphrase)
+        server.close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+def daemonize():
+    """
+    Detach from the terminal.  Returns in the child only.
+    """
+
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
@@ -27,9 +27,97 @@ NEWSSERVER = "localhost"
 # newsserver port
 NEWSPORT = 119
 
+# news servers (address, port) scanned by --fetch-aam.  Add more to
+# get messages from whichever server carries them first.
+NEWSSERVERS = [(NEWSSERVER, NEWSPORT)]
+
+# newsgroup scanned by --fetch-aam
+NEWSGROUP = 'alt.anonymous.messages'
+
+# articles per OVER/XOVER request when scanning NEWSGROUP
+OVER_CHUNK = 1000
+
+# parallel newsserver connections used to fetch articles
+NNTP_CONNECTIONS = 4
+
+# times a fetch is retried after a temporary newsserver error, and the
+# seconds to wait before each retry
+NNTP_RETRIES = 3
+NNTP_RETRY_DELAY = 5
+
+# gpg processes decrypting a.a.m messages at the same time
+DECRYPT_WORKERS = 4
+
+# days --fetch-aam remembers the Message-IDs of the messages it has
+# decrypted, so they are not fetched again after a --rollback
+SEEN_DAYS = 90
+
+# keep a compressed copy of every a.a.m article --fetch-aam scans, for
+# --rescan-spool.  This means fetching every article, not just ours.
+SPOOL = False
+SPOOL_DB = config_path+'/spool.db'
+
+# spooled articles are dropped after SPOOL_DAYS days, or sooner, oldest
+# first, once the spool holds more than SPOOL_MAX_MB megabytes
+SPOOL_DAYS = 30
+SPOOL_MAX_MB = 100
+
+# seconds between polls of --poll-aam, and the longest it waits between
+# attempts while the news server is failing
+POLL_INTERVAL = 600
+POLL_MAX_DELAY = 3600
+
+# where --poll-aam stores the messages it finds
+MESSAGE_DIR = config_path+'/messages'
+
+# how decrypted a.a.m messages are stored: 'file' (one file per message,
+# in the current directory for --fetch-aam and MESSAGE_DIR for
+# --poll-aam), 'maildir' or 'mbox' (all of them in the mailbox MAILBOX).
+# An mbox is synced to disk every MBOX_SYNC messages.
+SINK = 'file'
+MAILBOX = config_path+'/mailbox'
+MBOX_SYNC = 20
+
 # location of keys database
 KEYS_DB = config_path+'/keys.db'
 
+# number of records in the keys.db journal before keys.db is rewritten.
+# Each record costs one gpg decrypt whenever keys.db is opened.
+JOURNAL_MAX = 8
+
+# unix socket of the encodher agent
+AGENT_SOCKET = config_path+'/agent.sock'
+
+# seconds the encodher agent waits for a request before it exits
+AGENT_TIMEOUT = 3600
+
 # symmetric cipher to be used - any cipher from gpg --version can go here
 CIPHER = 'AES256'
 #CIPHER = 'CAMELLIA256'
+
+# location of the OpenSSL DH parameters file
+DHPARAMS = '/usr/local/lib/dhparams.pem'
+
+# Diffie-Hellman backend: 'm2crypto', 'pydhe', 'legacy', or 'auto' to use
+# m2crypto (or pydhe without M2Crypto) when DHPARAMS exists, and legacy
+# when it doesn't.  The ENCODHER_DH_BACKEND environment variable
+# overrides it.  Everyone you talk to must use the same group: m2crypto
+# and pydhe share the 8192-bit dhparams.pem group, legacy has its own.
+DH_BACKEND = 'auto'
+
+# bits in the DH private exponent of new keys, per backend.  About
+# twice the security level of the group is enough, and is many times
+# faster for key generation and shared secrets than a full-length
+# exponent.  Keys made with any other length keep working.  Set the
+# m2crypto entry to None to let OpenSSL choose (full length).
+EXPONENT_BITS = {'m2crypto': 640, 'pydhe': 640, 'legacy': 576}
+
+# precomputed powers of the DH generator used to make public keys: the
+# cache file of each group (%s is a hash of the group), and the exponent
+# bits covered by each table entry
+FIXEDBASE_CACHE = config_path+'/fixedbase-%s.dat'
+FIXEDBASE_WINDOW = 4
+
+# use GMP (the gmpy2 module) for the DH arithmetic when it is installed.
+# Run python dhgroup.py to check it against python's own arithmetic.
+USE_GMPY2 = True
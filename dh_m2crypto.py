@@ -27,23 +27,57 @@ and released under the GNU General Public License.
 
 import hashlib
 from binascii import hexlify
-from M2Crypto import DH
+from M2Crypto import DH, Rand
 from constants import *
+from dhgroup import DHGroup
+
+_group = None
+
+def getGroup():
+    """
+    Load OpenSSL dhparams from dhparams.pem file once per process - the
+    encoDHer distribution includes a 8192 bit prime in dhparams.pem. Also,
+    strip the OpenSSL headers from the imported dhparams and convert to long.
+    The loaded M2Crypto params are kept on the group for key generation.
+    """
+    global _group
+    if _group is None:
+        params = DH.load_params(DHPARAMS)
+        _group = DHGroup(long(hexlify(params.p)[10:], 16),
+                         int(hexlify(params.g)[8:], 16),
+                         exponentBits=EXPONENT_BITS['m2crypto'])
+        _group.params = params
+    return _group
+
+def deriveKey(privateKey, otherKey):
+    """
+    Derive the shared key from a stored private key and the other
+    party's public key without generating a throwaway keypair.
+    """
+    return getGroup().genKey(privateKey, otherKey)
 
 class DiffieHellman(object):
 
-    def __init__(self):
+    def __init__(self, bits=None):
         """
-        Load OpenSSL dhparams from dhparams.pem file - the encoDHer distribution
-        includes a 8192 bit prime in dhparams.pem. Also, strip the OpenSSL headers
-        from the imported dhparams and convert to long.
+        Generate a keypair using the cached dhparams, so dhparams.pem is
+        not parsed again for every key.  OpenSSL always makes a
+        full-length private exponent, so a shorter one (bits, default
+        EXPONENT_BITS['m2crypto']) is drawn from the OpenSSL random
+        generator instead.
         """
-        self.dh = DH.load_params('/usr/local/lib/dhparams.pem')
-        self.dh.gen_key()
-        self.prime = long(hexlify(self.dh.p)[10:], 16)
-        self.generator = int(hexlify(self.dh.g)[8:], 16)
-        self.privateKey = long(hexlify(self.dh.priv)[8:], 16)
-        self.publicKey = long(hexlify(self.dh.pub)[8:], 16)
+        group = getGroup()
+        self.prime = group.prime
+        self.generator = group.generator
+        bits = bits or EXPONENT_BITS['m2crypto']
+        if bits:
+            self.privateKey = long(hexlify(Rand.rand_bytes(bits>>3)), 16)
+            self.publicKey = group.genPublicKey(self.privateKey)
+        else:
+            self.dh = DH.set_params(group.params.p, group.params.g)
+            self.dh.gen_key()
+            self.privateKey = long(hexlify(self.dh.priv)[8:], 16)
+            self.publicKey = long(hexlify(self.dh.pub)[8:], 16)
 
     def genSecret(self, privateKey, otherKey):
         """
@@ -53,8 +87,7 @@ class DiffieHellman(object):
         for SSL/TLS encryption, so it has no idea about importing or exporting
         keys for use later. So we use this hack - but it's not too ugly!
         """
-        sharedSecret = pow(otherKey, privateKey, self.prime)
-        return sharedSecret
+        return getGroup().genSecret(privateKey, otherKey)
 
     def genKey(self, privateKey, otherKey):
         """
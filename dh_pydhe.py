@@ -27,6 +27,8 @@ and released under the GNU General Public License.
 
 from binascii import hexlify
 import hashlib
+from constants import *
+from dhgroup import DHGroup
 
 # If a secure random number generator is unavailable, exit with an error.
 try:
@@ -53,11 +55,12 @@ class DiffieHellman(object):
 
     generator = 5
     
-    def __init__(self):
+    def __init__(self, bits=None):
         """
-        Generate the public and private keys.
+        Generate the public and private keys, with a private exponent of
+        bits bits (default EXPONENT_BITS['pydhe']).
         """
-        self.privateKey = self.genPrivateKey(8192)
+        self.privateKey = self.genPrivateKey(bits or EXPONENT_BITS['pydhe'])
         self.publicKey = self.genPublicKey()
 
     
@@ -72,7 +75,7 @@ class DiffieHellman(object):
         """
         Generate a public key X with g**x % p.
         """
-        return pow(self.generator, self.privateKey, self.prime)
+        return getGroup().genPublicKey(self.privateKey)
 
 
     def checkPublicKey(self, otherKey):
@@ -80,10 +83,7 @@ class DiffieHellman(object):
         Check the other party's public key to make sure it's valid.
         Since a safe prime is used, verify that the Legendre symbol is equal to one.
         """
-        if(otherKey > 2 and otherKey < self.prime - 1):
-            if(pow(otherKey, (self.prime - 1)/2, self.prime) == 1):
-                return True
-        return False
+        return getGroup().checkPublicKey(otherKey)
 
         
     def genSecret(self, privateKey, otherKey):
@@ -93,7 +93,7 @@ class DiffieHellman(object):
         Symbol check because OpenSSL does not use this for their primes and
         we want to be compatible with the OpenSSL implementation.
         """
-        sharedSecret = pow(otherKey, privateKey, self.prime)
+        sharedSecret = getGroup().genSecret(privateKey, otherKey)
         return sharedSecret
             
     
@@ -133,6 +133,25 @@ class DiffieHellman(object):
         print "Shared key: ", hexlify(self.key)
         print
 
+_group = None
+
+def getGroup():
+    """
+    Return the DHGroup for this backend, created once per process.
+    """
+    global _group
+    if _group is None:
+        _group = DHGroup(DiffieHellman.prime, DiffieHellman.generator,
+                         exponentBits=EXPONENT_BITS['pydhe'])
+    return _group
+
+def deriveKey(privateKey, otherKey):
+    """
+    Derive the shared key from a stored private key and the other
+    party's public key without generating a throwaway keypair.
+    """
+    return getGroup().genKey(privateKey, otherKey)
+
 if __name__ == '__main__':
     """
     Run an example Diffie-Hellman exchange 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+encoDHer - a python package for symmetric encryption of email
+using the Diffie-Hellman shared secret key protocol.
+
+Copyright (C) 2013 by David R. Andersen
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, see https://github.com/rxcomm/encoDHer
+
+The registry of Diffie-Hellman backends (the dh_* modules).  The
+backend is chosen by DH_BACKEND, or the ENCODHER_DH_BACKEND environment
+variable, and only imported the first time a key is made or a shared
+secret derived, so commands that need neither don't pay for M2Crypto.
+"""
+import os
+import sys
+import time
+import importlib
+from constants import *
+
+class BackendError(Exception):
+    """
+    Raised when the configured DH backend can't be used
+    """
+    pass
+
+class Backend(object):
+
+    def __init__(self, name, module, description):
+        self.name = name
+        self.module = module
+        self.description = description
+        self._module = None
+
+    def load(self):
+        """
+        Import the backend module, once.  Raises ImportError (or whatever
+        the module raises) if it can't be used here.
+        """
+        if self._module is None:
+            self._module = importlib.import_module(self.module)
+        return self._module
+
+    def available(self):
+        try:
+            self.load()
+            return True
+        except Exception:
+            return False
+
+    def capabilities(self):
+        """
+        return the group size, the private exponent size of new keys (None
+        for full length), whether public key validation includes the
+        subgroup (Legendre symbol) check, and the arithmetic (python or
+        gmpy2)
+        """
+        group = self.load().getGroup()
+        return {'groupBits': group.prime.bit_length(),
+                'exponentBits': EXPONENT_BITS[self.name],
+                'checksSubgroup': group.checksSubgroup(),
+                'arithmetic': group.arithmetic}
+
+BACKENDS = [Backend('m2crypto', 'dh_m2crypto', 'M2Crypto/OpenSSL, dhparams.pem'),
+            Backend('pydhe', 'dh_pydhe', 'pyDHE, 8192-bit dhparams.pem prime built in'),
+            Backend('legacy', 'dh_legacy', '6144-bit RFC 3526 prime with generator 2')]
+
+_backend = None
+
+def byName(name):
+    for backend in BACKENDS:
+        if backend.name == name:
+            return backend
+    raise KeyError(name)
+
+def choose(name=None):
+    """
+    Pick a backend by name, or with 'auto': m2crypto if dhparams.pem is
+    installed and M2Crypto works, else pydhe, and legacy without
+    dhparams.pem.  Raises BackendError if the backend can't be loaded.
+    With dhparams.pem installed, 'auto' never falls back to legacy: its
+    group is different, so keys made with it would not match the
+    routes already in keys.db.
+    """
+    name = name or os.environ.get('ENCODHER_DH_BACKEND') or DH_BACKEND
+    if name == 'auto':
+        if not os.path.exists(DHPARAMS):
+            return byName('legacy')
+        try:
+            byName('m2crypto').load()
+            return byName('m2crypto')
+        except Exception:
+            name = 'pydhe'
+    try:
+        backend = byName(name)
+    except KeyError:
+        raise BackendError('Unknown DH backend: %s (choose from %s or auto)' % (
+            name, ', '.join(backend.name for backend in BACKENDS)))
+    try:
+        backend.load()
+    except Exception as e:
+        raise BackendError('DH backend %s can\'t be loaded: %s' % (
+            name, str(e) or e.__class__.__name__))
+    return backend
+
+def get():
+    """
+    return the module of the selected backend, loading it on first use
+    """
+    global _backend
+    if _backend is None:
+        try:
+            _backend = choose()
+        except BackendError as e:
+            print e
+            sys.exit(1)
+    return _backend.load()
+
+def bench(backend, rounds=3):
+    """
+    Time key generation and shared secret derivation with a backend.
+    Returns (seconds per key, seconds per secret).
+    """
+    module = backend.load()
+    start = time.time()
+    keys = [module.DiffieHellman() for i in range(rounds+1)]
+    keygen = (time.time()-start)/(rounds+1)
+    start = time.time()
+    for i in range(rounds):
+        module.deriveKey(keys[i].privateKey, keys[i+1].publicKey)
+    derive = (time.time()-start)/rounds
+    return keygen, derive
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+encoDHer - a python package for symmetric encryption of email
+using the Diffie-Hellman shared secret key protocol.
+
+Copyright (C) 2013 by David R. Andersen
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, see https://github.com/rxcomm/encoDHer
+"""
+
+import os
+import sys
+import time
+import random
+import marshal
+import hashlib
+from constants import *
+
+# The big-number arithmetic: an integer type and a modular power for it.
+# GMP (through gmpy2) is used when it is installed, since it is many
+# times faster than python's own longs at these sizes.
+ARITHMETICS = {'python': (long, pow)}
+try:
+    import gmpy2
+    ARITHMETICS['gmpy2'] = (gmpy2.mpz, gmpy2.powmod)
+except ImportError:
+    pass
+
+def jacobi(a, n):
+    """
+    The Jacobi symbol (a/n) for odd n > 0, by quadratic reciprocity.  For
+    a prime n it is the Legendre symbol, and with a small a it costs a
+    few divisions instead of a full-size pow.
+    """
+    a = a % n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a /= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a = a % n
+    return result if n == 1 else 0
+
+def defaultArithmetic():
+    if USE_GMPY2 and 'gmpy2' in ARITHMETICS:
+        return 'gmpy2'
+    return 'python'
+
+
+class FixedBase(object):
+    """
+    Powers of a fixed base g for exponents of up to bits bits, by Yao's
+    method: with g^(2^(w*i)) precomputed for every w-bit digit i of the
+    exponent, g^x takes about bits/w + 2^(w+1) multiplications instead
+    of the bits squarings of pow.  The table is built once and kept in
+    FIXEDBASE_CACHE, so later processes only have to read it.
+    """
+
+    def __init__(self, base, modulus, bits, window=FIXEDBASE_WINDOW, arithmetic=None):
+        self.base = base
+        self.modulus = modulus
+        self.bits = bits
+        self.window = window
+        self.digits = (bits+window-1)/window
+        self.number, self.powmod = ARITHMETICS[arithmetic or defaultArithmetic()]
+        self.table = None
+
+    def cacheFile(self):
+        params = '%x:%x:%d:%d' % (self.base, self.modulus, self.window, self.digits)
+        return FIXEDBASE_CACHE % hashlib.sha256(params).hexdigest()[:16]
+
+    def load(self):
+        """
+        Read the table from its cache file, or build it and save it there.
+        The file holds the marshalled table and its sha256, so a cache
+        that is damaged anywhere is rebuilt rather than used.
+        """
+        modulus = self.number(self.modulus)
+        try:
+            with open(self.cacheFile(), 'rb') as f:
+                digest, data = marshal.load(f)
+            if hashlib.sha256(data).hexdigest() == digest:
+                table = marshal.loads(data)
+                if len(table) == self.digits and table[0] == self.base:
+                    self.table = [self.number(x) for x in table]
+                    return
+        except (IOError, EOFError, ValueError, TypeError, IndexError):
+            pass
+
+        table = [self.number(self.base)]
+        for i in range(self.digits-1):
+            x = table[-1]
+            for j in range(self.window):
+                x = x*x % modulus
+            table.append(x)
+        self.table = table
+        try:
+            tmp_name = self.cacheFile()+'.%d' % os.getpid()
+            data = marshal.dumps([long(x) for x in table])
+            with open(tmp_name, 'wb') as f:
+                marshal.dump((hashlib.sha256(data).hexdigest(), data), f)
+            os.rename(tmp_name, self.cacheFile())
+        except (IOError, OSError):
+            pass
+
+    def pow(self, exponent):
+        """
+        return base^exponent mod modulus
+        """
+        if exponent < 0 or exponent >> self.bits:
+            return long(self.powmod(self.number(self.base), exponent, self.number(self.modulus)))
+        if self.table is None:
+            self.load()
+        modulus = self.number(self.modulus)
+        mask = (1<<self.window)-1
+        digits = [(exponent >> (self.window*i)) & mask for i in range(self.digits)]
+        result = partial = self.number(1)
+        for d in range(mask, 0, -1):
+            for i in range(self.digits):
+                if digits[i] == d:
+                    partial = partial*self.table[i] % modulus
+            result = result*partial % modulus
+        return long(result)
+
+
+class DHGroup(object):
+    """
+    The Diffie-Hellman group parameters (prime and generator) shared by
+    all of the dh_* backends.  A DHGroup holds no keypair, so a single
+    instance can be used for every shared secret derived in a process.
+    Results are always python longs, whatever the arithmetic.
+    """
+
+    def __init__(self, prime, generator, exponentBits=None, arithmetic=None):
+        self.prime = prime
+        self.generator = generator
+        self.subgroup = None
+        self.arithmetic = arithmetic or defaultArithmetic()
+        self.number, self.powmod = ARITHMETICS[self.arithmetic]
+        self.modulus = self.number(prime)
+        self.fixedBase = FixedBase(generator, prime, exponentBits or prime.bit_length(),
+                                   arithmetic=self.arithmetic)
+
+    def genPublicKey(self, privateKey):
+        """
+        Generate a public key X with g**x % p, using the fixed-base table
+        """
+        return self.fixedBase.pow(privateKey)
+
+    def checksSubgroup(self):
+        """
+        True if the generator is a quadratic residue, so that all public
+        keys lie in the prime order subgroup of the safe prime.  OpenSSL's
+        generator 5 generates the whole group instead, and then public
+        keys of either Legendre symbol are valid.
+        """
+        if self.subgroup is None:
+            self.subgroup = jacobi(self.generator, self.prime) == 1
+        return self.subgroup
+
+    def checkPublicKey(self, otherKey):
+        """
+        Check the other party's public key to make sure it's valid: it
+        must not be 0, 1 or p-1, and if the generator only generates the
+        prime order subgroup, its Legendre symbol must be equal to one.
+        """
+        if(otherKey > 1 and otherKey < self.prime - 1):
+            if not self.checksSubgroup():
+                return True
+            if(self.powmod(self.number(otherKey), (self.prime - 1)/2, self.modulus) == 1):
+                return True
+        return False
+
+    def genSecret(self, privateKey, otherKey):
+        """
+        Combine the other party's public key with our private key to
+        generate a shared secret.  The public key is not checked here;
+        keys.db checks it once, when the key is stored.
+        """
+        return long(self.powmod(self.number(otherKey), privateKey, self.modulus))
+
+    def genKey(self, privateKey, otherKey):
+        """
+        Derive the shared secret, then hash it to obtain the shared
+        key used for AES256 encryption.
+        """
+        s = hashlib.sha256()
+        s.update(str(self.genSecret(privateKey, otherKey)))
+        return s.digest()
+
+
+def selfTest(prime, generator, exponentBits, rounds=5):
+    """
+    Check that every available arithmetic gives the same public keys,
+    shared secrets and key checks as plain pow, and time them.  Returns
+    False on any mismatch.
+    """
+    groups = [DHGroup(prime, generator, exponentBits=exponentBits, arithmetic=name)
+              for name in sorted(ARITHMETICS)]
+    exponents = [random.getrandbits(exponentBits) for i in range(rounds)]
+    expected = [pow(generator, x, prime) for x in exponents]
+    ok = True
+    for group in groups:
+        start = time.time()
+        keys = [group.genPublicKey(x) for x in exponents]
+        keygen = (time.time()-start)/rounds
+        start = time.time()
+        secrets = [group.genSecret(x, y) for x, y in zip(exponents, reversed(keys))]
+        derive = (time.time()-start)/rounds
+        checks = [group.checkPublicKey(y) for y in keys+[1, prime-1, prime+5]]
+        residue = pow(generator, (prime-1)/2, prime) == 1
+        match = residue == group.checksSubgroup()
+        match = (match and keys == expected and
+                 secrets == [pow(y, x, prime) for x, y in zip(exponents, reversed(expected))] and
+                 checks == [not residue or pow(y, (prime-1)/2, prime) == 1
+                            for y in expected]+[False]*3)
+        print '%-7s %5d-bit group: keygen %.4f s, derive %.4f s, %s' % (
+            group.arithmetic, prime.bit_length(), keygen, derive, 'ok' if match else 'MISMATCH')
+        ok = ok and match
+    return ok
+
+if __name__ == '__main__':
+    """
+    Self-test the arithmetic with the built-in groups
+    """
+
+    import dh_pydhe
+    import dh_legacy
+    ok = True
+    for backend, name in ((dh_pydhe, 'pydhe'), (dh_legacy, 'legacy')):
+        ok = selfTest(backend.DiffieHellman.prime, backend.DiffieHellman.generator,
+                      EXPONENT_BITS[name]) and ok
+    sys.exit(0 if ok else 1)
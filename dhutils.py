@@ -24,29 +24,23 @@ import sqlite3
 import sys
 import os
 import time
+import re
+import json
+import fcntl
 import hashlib
+import dhbackend
 from getpass import getpass
 from binascii import hexlify
 from constants import *
-try:
-    with open('/usr/local/lib/dhparams.pem'):
-        try:
-            from dh_m2crypto import *
-            print 'Using M2Crypto/OpenSSL'
-        except:
-            from dh_pydhe import *
-            print 'Using pyDHE'
-except IOError:
-    print 'No dhparams.pem file found - using 6144-bit RFC 3526 prime'
-    print 'with generator 2'
-    from dh_legacy import *
+
+SCHEMA_VERSION = 7
 
 def makeKeys():
     """
     Create a DH keyset
     """
 
-    a = DiffieHellman()
+    a = dhbackend.get().DiffieHellman()
     privkey = a.privateKey
     pubkey = a.publicKey
     return str(privkey), str(pubkey)
@@ -54,30 +48,515 @@ def makeKeys():
 def initDB(gpg,dbpassphrase):
     """
     Initialize the database with the keys table format and
-    a timestamp marking the beginning of time to search a.a.m
+    a timestamp marking the beginning of time to search a.a.m.
+    Any article high-water marks are dropped.
     """
 
     timeStamp = time.time()
 
-    try:
-        with open(KEYS_DB): pass
-        db = openDB(KEYS_DB,gpg,dbpassphrase)
-    except IOError:
-        db = sqlite3.connect(':memory:')
+    with DBLock(KEYS_DB):
+        try:
+            with open(KEYS_DB): pass
+            db = openDB(KEYS_DB,gpg,dbpassphrase)
+        except IOError:
+            db = sqlite3.connect(':memory:', factory=KeysDB, check_same_thread=False)
+            migrateDB(db)
+
+        with db:
+
+            cur = db.cursor()
+            cur.execute('INSERT OR REPLACE INTO news (Id, LastReadTime) VALUES(?,?)', (1,timeStamp))
+            cur.execute('DELETE FROM highwater')
+        closeDB(db, KEYS_DB, gpg,dbpassphrase)
+    os.chmod(KEYS_DB,0600)
+
+def createTables(cur):
+    """
+    Create any missing tables and indexes of the current schema.
+    Routes are unique on (FromEmail, ToEmail).  KeyValid records whether
+    OtherPublicKey passed checkPublicKey (NULL if not checked yet).
+    """
+
+    cur.execute('CREATE TABLE IF NOT EXISTS keys (FromEmail TEXT, ToEmail TEXT, SecretKey TEXT, PublicKey TEXT, OtherPublicKey TEXT, TimeStamp FLOAT, KeyValid INTEGER)')
+    cur.execute('CREATE TABLE IF NOT EXISTS news (Id INTEGER PRIMARY KEY, LastReadTime FLOAT)')
+    cur.execute('CREATE TABLE IF NOT EXISTS version (Id INTEGER PRIMARY KEY, SchemaVersion INTEGER)')
+    cur.execute('CREATE TABLE IF NOT EXISTS journal (Id INTEGER PRIMARY KEY, Generation INTEGER)')
+    cur.execute('CREATE TABLE IF NOT EXISTS secrets (KeyHash TEXT PRIMARY KEY, SharedSecret TEXT)')
+    cur.execute('CREATE TABLE IF NOT EXISTS highwater (Server TEXT, NewsGroup TEXT, Article INTEGER, PRIMARY KEY (Server, NewsGroup))')
+    cur.execute('CREATE TABLE IF NOT EXISTS seen (MessageId TEXT PRIMARY KEY, TimeStamp FLOAT)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS keys_route ON keys (FromEmail, ToEmail)')
+
+def migrateDB(db):
+    """
+    Upgrade a database to SCHEMA_VERSION.  Databases created before
+    the schema was versioned have no route index and may contain
+    duplicate routes; only the first copy of a route is kept, since
+    that is the one getKeys has always returned.  Routes from before
+    version 6 have their public keys checked on first use.  Before
+    version 7, high-water marks were kept under the bare host name;
+    they are moved to host:NEWSPORT.
+    """
 
     with db:
 
         cur = db.cursor()
-        cur.execute('CREATE TABLE IF NOT EXISTS keys (FromEmail TEXT, ToEmail TEXT, SecretKey TEXT, PublicKey TEXT, OtherPublicKey TEXT, TimeStamp FLOAT)')
-        cur.execute('CREATE TABLE IF NOT EXISTS news (Id INTEGER PRIMARY KEY, LastReadTime FLOAT)')
-        cur.execute('INSERT OR REPLACE INTO news (Id, LastReadTime) VALUES(?,?)', (1,timeStamp))
-    closeDB(db, KEYS_DB, gpg,dbpassphrase)
-    os.chmod(KEYS_DB,0600)
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='version'")
+        if cur.fetchone():
+            cur.execute('SELECT SchemaVersion FROM version WHERE Id = 1')
+            row = cur.fetchone()
+            version = row[0] if row else 0
+        else:
+            version = 0
+
+        if version < 1:
+            cur.execute('CREATE TABLE IF NOT EXISTS keys (FromEmail TEXT, ToEmail TEXT, SecretKey TEXT, PublicKey TEXT, OtherPublicKey TEXT, TimeStamp FLOAT)')
+            cur.execute('DELETE FROM keys WHERE rowid NOT IN (SELECT MIN(rowid) FROM keys GROUP BY FromEmail, ToEmail)')
+            if cur.rowcount > 0:
+                print 'Removed %d duplicate routes from keys.db' % cur.rowcount
+
+        if version < 6:
+            cur.execute('PRAGMA table_info(keys)')
+            if 'KeyValid' not in [column[1] for column in cur.fetchall()]:
+                cur.execute('ALTER TABLE keys ADD COLUMN KeyValid INTEGER')
+
+        if version < 7:
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='highwater'")
+            if cur.fetchone():
+                cur.execute("UPDATE highwater SET Server = Server || ? WHERE Server NOT LIKE '%:%'",
+                            (':%d' % NEWSPORT,))
+
+        if version != SCHEMA_VERSION:
+            createTables(cur)
+            cur.execute('INSERT OR REPLACE INTO version (Id, SchemaVersion) VALUES(?,?)', (1,SCHEMA_VERSION))
+
+class RouteExists(Exception):
+    """
+    Raised when an operation would create a second key for a route
+    """
+    pass
+
+class KeyStore(object):
+    """
+    Route and news timestamp operations on an open keys.db.  KeyStore
+    methods neither print nor save; the caller decides when to closeDB.
+    Session and the encodher agent expose the same methods.
+    """
+
+    readOps = ('getKeys', 'isKeyValid', 'listRoutes', 'countRoutes', 'getNewsTimestamp',
+               'getHighWater', 'getSeen')
+    # deriving secrets can add to the secrets cache, so it counts as a write
+    writeOps = ('insertKeys', 'cloneKey', 'changePubKey', 'changeToEmail',
+                'changeFromEmail', 'deleteKey', 'mutateKey', 'setNewsTimestamp',
+                'genSharedSecret', 'getListOfKeys', 'setHighWater', 'clearHighWater',
+                'addSeen', 'expireSeen')
+
+    def __init__(self, db):
+        self.db = db
+
+    def getKeys(self, fromEmail, toEmail):
+        """
+        return privkey, mypubkey, otherpubkey for the fromEmail -> toEmail
+        route, or None if there is no such route
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT SecretKey, PublicKey, OtherPublicKey FROM keys WHERE FromEmail = ? AND ToEmail = ?', (fromEmail,toEmail))
+        row = cur.fetchone()
+        if row:
+            return row[0], row[1], row[2]
+
+    def isKeyValid(self, fromEmail, toEmail):
+        """
+        return whether the public key of the fromEmail -> toEmail route
+        passed checkPublicKey, or None if it hasn't been checked yet or
+        there is no such route
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT KeyValid FROM keys WHERE FromEmail = ? AND ToEmail = ?', (fromEmail,toEmail))
+        row = cur.fetchone()
+        if row and row[0] is not None:
+            return bool(row[0])
+
+    def listRoutes(self):
+        """
+        return a list of (fromEmail, toEmail) for every route
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT FromEmail, ToEmail FROM keys')
+        return cur.fetchall()
+
+    def countRoutes(self):
+        cur = self.db.cursor()
+        cur.execute('SELECT COUNT(*) FROM keys')
+        return cur.fetchone()[0]
+
+    def insertKeys(self, fromEmail, toEmail, otherpubkey):
+        """
+        Create a new keyset for the fromEmail -> toEmail route
+        """
+        timeStamp = time.time()
+        privkey, mypubkey = makeKeys()
+        valid = checkPublicKey(otherpubkey)
+        with self.db:
+            cur = self.db.cursor()
+            try:
+                cur.execute('INSERT INTO keys (FromEmail, ToEmail, SecretKey, PublicKey, OtherPublicKey, TimeStamp, KeyValid) VALUES(?,?,?,?,?,?,?)', (fromEmail,toEmail,privkey,mypubkey,otherpubkey,timeStamp,valid))
+            except sqlite3.IntegrityError:
+                raise RouteExists(fromEmail, toEmail)
+
+    def cloneKey(self, fromEmail, toEmail, newFromEmail, newToEmail):
+        """
+        Clone key from route fromEmail -> toEmail to new route
+        newFromEmail -> newToEmail.  return False if there is no
+        fromEmail -> toEmail route
+        """
+        with self.db:
+            cur = self.db.cursor()
+            try:
+                cur.execute('INSERT INTO keys (FromEmail, ToEmail, SecretKey, PublicKey, OtherPublicKey, TimeStamp, KeyValid) SELECT ?, ?, SecretKey, PublicKey, OtherPublicKey, TimeStamp, KeyValid FROM keys WHERE FromEmail = ? AND ToEmail = ?', (newFromEmail,newToEmail,fromEmail,toEmail))
+            except sqlite3.IntegrityError:
+                raise RouteExists(newFromEmail, newToEmail)
+            return cur.rowcount > 0
+
+    def changePubKey(self, fromEmail, toEmail, pubkey):
+        """
+        Change the otherpubkey for the fromEmail -> toEmail route.
+        return False if there is no such route
+        """
+        valid = checkPublicKey(pubkey)
+        with self.db:
+            cur = self.db.cursor()
+            self.forgetSecret(fromEmail, toEmail)
+            cur.execute('UPDATE keys SET OtherPublicKey = ?, KeyValid = ? WHERE FromEmail = ? AND ToEmail = ?', (pubkey,valid,fromEmail,toEmail))
+            return cur.rowcount > 0
+
+    def changeToEmail(self, fromEmail, oldToEmail, newToEmail):
+        """
+        Change the toEmail address on the fromEmail -> oldToEmail route.
+        return False if there is no such route
+        """
+        with self.db:
+            cur = self.db.cursor()
+            try:
+                cur.execute('UPDATE keys SET ToEmail = ? WHERE FromEmail = ? AND ToEmail = ?', (newToEmail,fromEmail,oldToEmail))
+            except sqlite3.IntegrityError:
+                raise RouteExists(fromEmail, newToEmail)
+            return cur.rowcount > 0
+
+    def changeFromEmail(self, oldFromEmail, newFromEmail, toEmail):
+        """
+        Change the fromEmail address on the oldFromEmail -> toEmail route.
+        return False if there is no such route
+        """
+        with self.db:
+            cur = self.db.cursor()
+            try:
+                cur.execute('UPDATE keys SET FromEmail = ? WHERE FromEmail = ? AND ToEmail = ?', (newFromEmail,oldFromEmail,toEmail))
+            except sqlite3.IntegrityError:
+                raise RouteExists(newFromEmail, toEmail)
+            return cur.rowcount > 0
+
+    def deleteKey(self, fromEmail, toEmail):
+        """
+        Delete the fromEmail -> toEmail key.  return False if there is
+        no such route
+        """
+        with self.db:
+            cur = self.db.cursor()
+            self.forgetSecret(fromEmail, toEmail)
+            cur.execute('DELETE FROM keys WHERE FromEmail = ? AND ToEmail = ?', (fromEmail,toEmail))
+            return cur.rowcount > 0
+
+    def mutateKey(self, fromEmail, toEmail):
+        """
+        Change the privkey, mypubkey pair on the fromEmail -> toEmail route
+        without modifying the otherpubkey.  return False if there is no
+        such route
+        """
+        privkey, mypubkey = makeKeys()
+        with self.db:
+            cur = self.db.cursor()
+            self.forgetSecret(fromEmail, toEmail)
+            cur.execute('UPDATE keys SET SecretKey = ?, PublicKey = ? WHERE FromEmail = ? AND ToEmail = ?', (privkey,mypubkey,fromEmail,toEmail))
+            return cur.rowcount > 0
+
+    def sharedSecret(self, fromEmail, toEmail, privkey, otherpubkey, valid):
+        """
+        return the shared secret for the keypair of a route, or None if
+        otherpubkey is invalid.  A key that hasn't been checked yet (valid
+        is None) is checked now, and the verdict saved with the route.
+        Secrets are cached in the secrets table, keyed by secretHash, so
+        each one is only derived once.
+        """
+        if valid is None:
+            valid = checkPublicKey(otherpubkey)
+            if not self.db.readOnly:
+                with self.db:
+                    self.db.cursor().execute('UPDATE keys SET KeyValid = ? WHERE FromEmail = ? AND ToEmail = ?', (valid,fromEmail,toEmail))
+        if not valid:
+            return None
+        keyHash = secretHash(privkey, otherpubkey)
+        cur = self.db.cursor()
+        cur.execute('SELECT SharedSecret FROM secrets WHERE KeyHash = ?', (keyHash,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        try:
+            sSecret = hexlify(dhbackend.get().deriveKey(long(privkey),long(otherpubkey)))
+        except Exception:
+            return None
+        if not self.db.readOnly:
+            with self.db:
+                cur.execute('INSERT OR REPLACE INTO secrets (KeyHash, SharedSecret) VALUES(?,?)', (keyHash,sSecret))
+        return sSecret
+
+    def forgetSecret(self, fromEmail, toEmail):
+        """
+        Drop the cached shared secret of the fromEmail -> toEmail route
+        before its keys change.  insertKeys needs no such step, since a
+        new route always gets a newly generated private key.
+        """
+        keys = self.getKeys(fromEmail, toEmail)
+        if keys:
+            self.db.cursor().execute('DELETE FROM secrets WHERE KeyHash = ?', (secretHash(keys[0],keys[2]),))
+
+    def genSharedSecret(self, fromEmail, toEmail):
+        """
+        return the shared secret for the fromEmail -> toEmail route, or
+        None if there is no such route or its public key is invalid
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT SecretKey, OtherPublicKey, KeyValid FROM keys WHERE FromEmail = ? AND ToEmail = ?', (fromEmail,toEmail))
+        row = cur.fetchone()
+        if not row:
+            return None
+        return self.sharedSecret(fromEmail, toEmail, row[0], row[1], row[2])
+
+    def getListOfKeys(self):
+        """
+        return (fromEmail, toEmail, sharedSecret) for every route.  The
+        shared secret is None for routes with an invalid public key.
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT FromEmail, ToEmail, SecretKey, OtherPublicKey, KeyValid FROM keys')
+        return [(row[0], row[1], self.sharedSecret(*row))
+                for row in cur.fetchall()]
+
+    def getNewsTimestamp(self):
+        """
+        return the old timestamp for reading messages from a.a.m and the
+        current time
+        """
+        curTime = time.time()
+        cur = self.db.cursor()
+        cur.execute('SELECT LastReadTime FROM news WHERE Id = 1')
+        return int(cur.fetchone()[0])-1, curTime
+
+    def setNewsTimestamp(self, timeStamp):
+        """
+        Replace the old news timestamp with a new one for next time
+        """
+        with self.db:
+            self.db.cursor().execute('UPDATE news SET LastReadTime = ? WHERE Id = 1', (timeStamp,))
+
+    def getHighWater(self, server, group):
+        """
+        return the number of the last article read from group on server,
+        or None if the group has not been read there yet
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT Article FROM highwater WHERE Server = ? AND NewsGroup = ?',
+                    (server, group))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def setHighWater(self, server, group, article):
+        """
+        Record the last article read from group on server
+        """
+        with self.db:
+            self.db.cursor().execute('INSERT OR REPLACE INTO highwater (Server, NewsGroup, Article) VALUES(?,?,?)',
+                                     (server, group, article))
+
+    def getSeen(self, messageIds):
+        """
+        return the Message-IDs in messageIds that have already been
+        decrypted and stored by --fetch-aam
+        """
+        cur = self.db.cursor()
+        seen = []
+        for messageId in messageIds:
+            cur.execute('SELECT 1 FROM seen WHERE MessageId = ?', (messageId,))
+            if cur.fetchone():
+                seen.append(messageId)
+        return seen
+
+    def addSeen(self, messageId):
+        """
+        Record that an a.a.m message has been decrypted and stored
+        """
+        with self.db:
+            self.db.cursor().execute('INSERT OR REPLACE INTO seen (MessageId, TimeStamp) VALUES(?,?)',
+                                     (messageId, time.time()))
+
+    def expireSeen(self, timeStamp):
+        """
+        Forget the messages seen before timeStamp
+        """
+        with self.db:
+            self.db.cursor().execute('DELETE FROM seen WHERE TimeStamp < ?', (timeStamp,))
+
+    def clearHighWater(self):
+        """
+        Forget the article high-water marks, so the next a.a.m fetch
+        goes back to the news timestamp
+        """
+        with self.db:
+            self.db.cursor().execute('DELETE FROM highwater')
+
+def checkPublicKey(pubkey):
+    """
+    Validate the other party's public key (range and subgroup) in the
+    group of the selected DH backend
+    """
+
+    try:
+        return dhbackend.get().getGroup().checkPublicKey(long(pubkey))
+    except (ValueError, TypeError):
+        return False
+
+def secretHash(privkey, otherpubkey):
+    """
+    The secrets cache key for a keypair
+    """
+
+    return hashlib.sha256(str(privkey)+':'+str(otherpubkey)).hexdigest()
+
+class DBLock(object):
+    """
+    An exclusive lock on keys.db, for a with block.  It is held while
+    keys.db and its journal are read or written, so nobody writes them
+    between a Session checking that they haven't changed and saving.
+    """
+
+    def __init__(self, keys_db):
+        self.name = keys_db+'.lock'
+        self.f = None
+
+    def __enter__(self):
+        fd = os.open(self.name, os.O_WRONLY | os.O_CREAT, 0600)
+        self.f = os.fdopen(fd, 'w')
+        fcntl.lockf(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+        self.f = None
+        return False
+
+class Session(KeyStore):
+    """
+    A KeyStore for the length of a with block.  keys.db is decrypted
+    once on the way in and saved once, with closeDB, on the way out, so
+    a command costs at most one decrypt and one encrypt however many
+    operations it runs.  If the block raises an exception other than
+    SystemExit, the changes are discarded.  If another command has
+    saved keys.db in the meantime, the changes are merged into its
+    version (see merge) rather than written over it.
+    """
+
+    def __init__(self, keys_db, gpg, dbpassphrase, readOnly=False):
+        self.keys_db = keys_db
+        self.gpg = gpg
+        self.dbpassphrase = dbpassphrase
+        self.readOnly = readOnly
+        self.db = None
+
+    def __enter__(self):
+        self.load()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or issubclass(exc_type, SystemExit):
+            self.save()
+        self.db.close()
+        self.db = None
+        return False
+
+    def load(self):
+        with DBLock(self.keys_db):
+            self.db = openDB(self.keys_db,self.gpg,self.dbpassphrase,readOnly=self.readOnly)
+            self.fileState = self.getFileState()
+
+    def getFileState(self):
+        state = []
+        for name in (self.keys_db, self.keys_db+'.journal'):
+            try:
+                st = os.stat(name)
+                state.append((st.st_ino, st.st_mtime, st.st_size))
+            except OSError:
+                state.append(None)
+        return state
+
+    def save(self):
+        """
+        Save the changes so far without ending the session
+        """
+        if self.readOnly or not self.db.isDirty():
+            return
+        with DBLock(self.keys_db):
+            if self.getFileState() != self.fileState:
+                self.merge()
+            closeDB(self.db,self.keys_db,self.gpg,self.dbpassphrase)
+            self.fileState = self.getFileState()
+
+    def merge(self):
+        """
+        Another command has saved keys.db since we loaded it.  Saving our
+        copy would undo its changes if it is a snapshot, and be ignored
+        on replay if the other command took a snapshot (a new generation)
+        and ours is a journal record.  So load keys.db again and redo our
+        changes on top of it.  Called with the DBLock held.
+        """
+        self.db.commit()
+        changes = self.db.changes
+        db = openDB(self.keys_db,self.gpg,self.dbpassphrase)
+        try:
+            with db:
+                for statement, params in changes:
+                    db.execute(statement, params)
+        except sqlite3.Error as e:
+            print 'keys.db was changed by another encodher command, and the changes'
+            print 'made here conflict with it: %s' % e
+            sys.exit(1)
+        self.db.close()
+        self.db = db
+
+    def refresh(self):
+        """
+        Reload keys.db if another encodher command has changed it since
+        the session opened or last saved it.  Returns True if it did.
+        Unsaved changes are lost, so save first.
+        """
+        if self.getFileState() == self.fileState:
+            return False
+        self.db.close()
+        self.load()
+        return True
+
+def session(gpg,dbpassphrase,readOnly=False):
+    """
+    Return the store for route operations, to be used in a with block:
+    the encodher agent if one is running, otherwise a Session on keys.db.
+    """
 
-def rollback(days,gpg,dbpassphrase):
+    import agent
+    return agent.connect() or Session(KEYS_DB,gpg,dbpassphrase,readOnly)
+
+def rollback(days,store):
     """
     Roll back the database news timestamp.
-    The timestamp marks the beginning of time to search a.a.m
+    The timestamp marks the beginning of time to search a.a.m, and the
+    article high-water marks are dropped so the next fetch starts there.
     """
 
     try:
@@ -89,178 +568,112 @@ def rollback(days,gpg,dbpassphrase):
     HHMMSS = time.strftime('%H:%M:%S', time.gmtime(timeStamp))
 
     print 'a.a.m last read time rolled back to '+YYYYMMDD+' at '+HHMMSS+' GMT'
-    db = openDB(KEYS_DB,gpg,dbpassphrase)
-
-    with db:
-
-        cur = db.cursor()
-        cur.execute('UPDATE news SET LastReadTime = ? WHERE Id = ?', (timeStamp,1))
-    closeDB(db, KEYS_DB, gpg,dbpassphrase)
+    store.setNewsTimestamp(timeStamp)
+    store.clearHighWater()
 
-def insertKeys(fromEmail,toEmail,otherpubkey,gpg,dbpassphrase):
+def rollbackArticles(articles,server,group,store):
     """
-    Create a new keyset for the fromEmail -> toEmail route
+    Roll back the article high-water mark for group on server
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
-
-    with db:
-
-        timeStamp = time.time()
-        privkey, mypubkey = makeKeys()
-        cur = db.cursor()
-        cur.execute('CREATE TABLE IF NOT EXISTS keys (FromEmail TEXT, ToEmail TEXT, SecretKey TEXT, PublicKey TEXT, OtherPublicKey TEXT, TimeStamp INT)')
-        cur.execute('INSERT INTO keys VALUES(?,?,?,?,?,?)', (fromEmail,toEmail,privkey,mypubkey,otherpubkey,timeStamp))
-
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        print 'You have %d total routes' % len(rows)
-    closeDB(db, KEYS_DB, gpg,dbpassphrase)
+    try:
+        articles = int(articles)
+    except ValueError:
+        print 'Number of articles to roll back must be a whole number.'
+        sys.exit(1)
+    highWater = store.getHighWater(server,group)
+    if highWater is None:
+        print 'No articles have been read from '+group+' on '+server+' yet, nothing changed.'
+        return
+    highWater = max(highWater-articles, 0)
+    store.setHighWater(server,group,highWater)
+    print group+' on '+server+' rolled back to article %d' % highWater
 
-def getKeys(fromEmail,toEmail,gpg,dbpassphrase):
+def insertKeys(fromEmail,toEmail,otherpubkey,store):
     """
-    Get the key for the fromEmail -> toEmail route
-    return privkey, mypubkey, otherpubkey
+    Create a new keyset for the fromEmail -> toEmail route
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
-
-    with db:
-
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == fromEmail and row[1] == toEmail:
-                return row[2], row[3], row[4]
+    try:
+        store.insertKeys(fromEmail,toEmail,otherpubkey)
+    except RouteExists:
+        print 'Key already exists for the '+fromEmail+' -> '+toEmail+' route, nothing changed.'
+        return
+    print 'You have %d total routes' % store.countRoutes()
 
-def listKeys(gpg,dbpassphrase):
+def listKeys(store):
     """
     List routes for all keys in database
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
+    routes = store.listRoutes()
+    for route in routes:
+        print route[0]+' -> '+route[1]
+    print 'You have %d total routes' % len(routes)
 
-    with db:
-
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            print row[0]+' -> '+row[1]
-        print 'You have %d total routes' % len(rows)
-
-def cloneKey(fromEmail,toEmail,newFromEmail,newToEmail,gpg,dbpassphrase):
+def cloneKey(fromEmail,toEmail,newFromEmail,newToEmail,store):
    """
    Clone key from route fromEmail -> toEmail to new route newFromEmail -> newToEmail
    """
 
-   db = openDB(KEYS_DB, gpg,dbpassphrase)
+   try:
+       if not store.cloneKey(fromEmail,toEmail,newFromEmail,newToEmail):
+           print 'Matching key not found, nothing changed.'
+   except RouteExists:
+       print 'Key already exists for the '+newFromEmail+' -> '+newToEmail+' route, nothing changed.'
 
-   with db:
-
-       changed = False
-       cur = db.cursor()
-       cur.execute("SELECT * FROM keys")
-       rows = cur.fetchall()
-       for row in rows:
-           if row[0] == fromEmail and row[1] == toEmail:
-               changed = True
-               cur.execute('INSERT INTO keys VALUES(?,?,?,?,?,?)', (newFromEmail,newToEmail,row[2],row[3],row[4],row[5]))
-       if not changed: print 'Matching key not found, nothing changed.'
-   closeDB(db, KEYS_DB, gpg,dbpassphrase)
-
-def changePubKey(fromEmail,toEmail,pubkey,gpg,dbpassphrase):
+def changePubKey(fromEmail,toEmail,pubkey,store):
     """
     Change the otherpubkey for the fromEmail -> toEmail route
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
-
-    with db:
-
-        changed = False
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == fromEmail and row[1] == toEmail:
-                changed = True
-                cur.execute('UPDATE keys SET OtherPublicKey = ? WHERE FromEmail = ? AND ToEmail = ?', (pubkey,row[0],row[1]))
-        if not changed: print 'Matching key not found, nothing changed.'
-    closeDB(db, KEYS_DB, gpg,dbpassphrase)
+    if not store.changePubKey(fromEmail,toEmail,pubkey):
+        print 'Matching key not found, nothing changed.'
+        return
+    warnInvalidKey(fromEmail,toEmail,store)
 
-def changeToEmail(fromEmail,oldToEmail,newToEmail,gpg,dbpassphrase):
+def warnInvalidKey(fromEmail,toEmail,store):
     """
-    Change the toEmail address on the fromEmail -> oldToEmail route
+    Warn if the public key just stored for the fromEmail -> toEmail route
+    failed validation
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
-
-    with db:
-
-        changed = False
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == fromEmail and row[1] == oldToEmail:
-                changed = True
-                cur.execute('UPDATE keys SET ToEmail = ? WHERE FromEmail = ? AND ToEmail = ?', (newToEmail,row[0],row[1]))
-        if not changed: print 'Matching key not found, nothing changed.'
-    closeDB(db, KEYS_DB, gpg,dbpassphrase)
+    if store.isKeyValid(fromEmail,toEmail) is False:
+        print 'Invalid public key: %s -> %s, no messages can be sent on this route' % (fromEmail, toEmail)
 
-def changeFromEmail(oldFromEmail,newFromEmail,toEmail,gpg,dbpassphrase):
+def changeToEmail(fromEmail,oldToEmail,newToEmail,store):
     """
-    Change the fromEmail address on the oldFromEmail -> toEmail route
+    Change the toEmail address on the fromEmail -> oldToEmail route
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
-
-    with db:
-
-        changed = False
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == oldFromEmail and row[1] == toEmail:
-                changed = True
-                cur.execute('UPDATE keys SET FromEmail = ? WHERE FromEmail = ? AND ToEmail = ?', (newFromEmail,row[0],row[1]))
-        if not changed: print 'Matching key not found, nothing changed.'
-    closeDB(db, KEYS_DB, gpg,dbpassphrase)
+    try:
+        if not store.changeToEmail(fromEmail,oldToEmail,newToEmail):
+            print 'Matching key not found, nothing changed.'
+    except RouteExists:
+        print 'Key already exists for the '+fromEmail+' -> '+newToEmail+' route, nothing changed.'
 
-def deleteKey(fromEmail,toEmail,gpg,dbpassphrase):
+def changeFromEmail(oldFromEmail,newFromEmail,toEmail,store):
     """
-    Delete the fromEmail -> toEmail key from the database
+    Change the fromEmail address on the oldFromEmail -> toEmail route
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
-
-    with db:
-
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == fromEmail and row[1] == toEmail:
-                cur.execute('DELETE FROM keys WHERE FromEmail = ? AND ToEmail = ?', (fromEmail,toEmail))
-    closeDB(db, KEYS_DB, gpg,dbpassphrase)
+    try:
+        if not store.changeFromEmail(oldFromEmail,newFromEmail,toEmail):
+            print 'Matching key not found, nothing changed.'
+    except RouteExists:
+        print 'Key already exists for the '+newFromEmail+' -> '+toEmail+' route, nothing changed.'
 
-def genSharedSecret(fromEmail,toEmail,gpg,dbpassphrase):
+def genSharedSecret(fromEmail,toEmail,store):
     """
     Generate the shared secret for the fromEmail -> toEmail route
     """
 
-    try:
-        a = DiffieHellman()
-        privkey, mypubkey, otherpubkey = getKeys(fromEmail,toEmail,gpg,dbpassphrase)
-        a.genKey(long(privkey),long(otherpubkey))
-        return hexlify(a.key)
-    except Exception:
+    sSecret = store.genSharedSecret(fromEmail,toEmail)
+    if not sSecret:
         print 'Invalid public key: %s -> %s' % (fromEmail, toEmail)
+    return sSecret
 
-def mutateKey(fromEmail,toEmail,gpg,dbpassphrase):
+def mutateKey(fromEmail,toEmail,store):
     """
     Change the privkey, mypubkey pair on the fromEmail -> toEmail route
     without modifying the otherpubkey.  Also, create a mutatekey.asc file
@@ -271,77 +684,24 @@ def mutateKey(fromEmail,toEmail,gpg,dbpassphrase):
     the new key. (ephemeral DH - perfect forward secrecy)
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
-
-    with db:
-
-        changed = False
-        timeStamp = time.time()
-        privkey, mypubkey = makeKeys()
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == fromEmail and row[1] == toEmail:
-                changed = True
-                cur.execute('UPDATE keys SET SecretKey = ? WHERE FromEmail = ? AND ToEmail = ?', (privkey,fromEmail,toEmail))
-                cur.execute('UPDATE keys SET PublicKey = ? WHERE FromEmail = ? AND ToEmail = ?', (mypubkey,fromEmail,toEmail))
-        if not changed: print 'Matching key not found, nothing changed.'
-    closeDB(db,KEYS_DB,gpg,dbpassphrase)
-
-def getNewsTimestamp(gpg,dbpassphrase):
-    """
-    Get the old timestamp for reading messages from a.a.m.
-    Also, get the current time.
-    """
-    curTime = time.time()
-    db = openDB(KEYS_DB,gpg,dbpassphrase)
-    
-    with db:
-        cur = db.cursor()
-        cur.execute("SELECT * FROM news")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == 1: timeStamp = int(row[1])-1
-        closeDB(db,KEYS_DB,gpg,dbpassphrase)
-        return timeStamp, curTime
-
-def setNewsTimestamp(curTimeStamp,gpg,dbpassphrase):
-    """
-    Replace the old news timestamp with a new one for next time
-    """
-    db = openDB(KEYS_DB,gpg,dbpassphrase)
-
-    with db:
-        cur = db.cursor()
-        cur.execute("SELECT * FROM news")
-        rows = cur.fetchall()
-        for row in rows:
-            if row[0] == 1:
-                cur.execute('UPDATE news SET LastReadTime = ? WHERE Id = 1', (curTimeStamp,))
-        closeDB(db,KEYS_DB,gpg,dbpassphrase)
+    if not store.mutateKey(fromEmail,toEmail):
+        print 'Matching key not found, nothing changed.'
 
-def getListOfKeys(gpg,dbpassphrase):
+def getListOfKeys(store):
     """
     Get the route and shared secret for all keys in the database.  This
     will be used to query a.a.m for any messages associated with our keys.
     """
 
-    db = openDB(KEYS_DB, gpg,dbpassphrase)
     listOfKeys = []
-
-    with db:
-        cur = db.cursor()
-        cur.execute("SELECT * FROM keys")
-        rows = cur.fetchall()
-        for row in rows:
-            sSecret = genSharedSecret(row[0],row[1],gpg,dbpassphrase)
-            if sSecret:
-                listOfKeys.append((row[0],row[1],sSecret))
-        return listOfKeys
+    for fromEmail, toEmail, sSecret in store.getListOfKeys():
+        if sSecret:
+            listOfKeys.append((fromEmail,toEmail,sSecret))
+        else:
+            print 'Invalid public key: %s -> %s' % (fromEmail, toEmail)
+    return listOfKeys
 
 def changeDBKey(keys_db,gpg,dbpassphrase):
-    db = openDB(keys_db,gpg,dbpassphrase)
     passphrase1='1'
     passphrase2='2'
     while passphrase1 != passphrase2:
@@ -349,38 +709,310 @@ def changeDBKey(keys_db,gpg,dbpassphrase):
         passphrase2 = getpass('Retype: ')
         if passphrase1 != passphrase2:
             print 'Passphrase did not match.'
-    closeDB(db,keys_db,gpg,passphrase1)
+    with DBLock(keys_db):
+        db = openDB(keys_db,gpg,dbpassphrase)
+        db.markDirty()
+        closeDB(db,keys_db,gpg,passphrase1)
+
+def compactDB(keys_db,gpg,dbpassphrase):
+    """
+    Fold the keys.db journal back into a fresh keys.db snapshot
+    """
 
-def openDB(keys_db,gpg,dbpassphrase):
+    with DBLock(keys_db):
+        db = openDB(keys_db,gpg,dbpassphrase)
+        records = db.journalRecords
+        db.markDirty()
+        closeDB(db,keys_db,gpg,dbpassphrase)
+    print 'Compacted %d journal records into keys.db' % records
 
-    db = sqlite3.connect(':memory:')
+class JournalCursor(sqlite3.Cursor):
+    """
+    A cursor that remembers the statements that modify the database,
+    so closeDB can journal them instead of rewriting all of keys.db.
+    """
 
-    with open(keys_db, 'rb') as f:
-        sql = gpg.decrypt_file(f, passphrase=dbpassphrase)
-        if not sql:
-            print 'Bad passphrase!'
-            sys.exit(1)
-        db.cursor().executescript(str(sql))
+    def execute(self, sql, params=()):
+        result = sqlite3.Cursor.execute(self, sql, params)
+        if sql.split(None, 1)[0].upper() in ('INSERT','UPDATE','DELETE','CREATE','ALTER','DROP'):
+            self.connection.pending.append((sql, list(params)))
+        return result
+
+class KeysDB(sqlite3.Connection):
+    """
+    The in-memory copy of keys.db.  It remembers whether anything has
+    been written since it was loaded, so closeDB only re-encrypts
+    keys.db when something actually changed.  Committed statements are
+    kept in changes so closeDB can append them to the journal.
+    """
+
+    readOnly = False
+    cleanChanges = 0
+    dirty = False
+    journalRecords = 0
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.pending = []
+        self.changes = []
+
+    def cursor(self, factory=JournalCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def commit(self):
+        sqlite3.Connection.commit(self)
+        self.changes.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        sqlite3.Connection.rollback(self)
+        self.pending = []
+
+    def markClean(self):
+        self.cleanChanges = self.total_changes
+        self.dirty = False
+        self.pending = []
+        self.changes = []
+
+    def markDirty(self):
+        self.dirty = True
+
+    def isDirty(self):
+        return self.dirty or self.total_changes != self.cleanChanges
+
+class DumpReader(object):
+    """
+    A file-like view of db.iterdump(), so the SQL dump can be streamed
+    to gpg a block at a time instead of being built up as one string.
+    python-gnupg reads it from its own thread, which is why keys.db
+    connections are opened with check_same_thread=False.
+    """
+
+    def __init__(self, db):
+        self.lines = db.iterdump()
+        self.buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.lines).encode('utf-8')+'\n'
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        return data
+
+class DumpLoader(object):
+    """
+    Load an SQL dump into a database as it arrives.  Complete statements
+    are collected and executed in batches of roughly batchSize bytes, each
+    in its own transaction.
+    """
+
+    def __init__(self, db, batchSize=65536):
+        self.db = db
+        self.batchSize = batchSize
+        self.partial = ''
+        self.statement = []
+        self.script = []
+        self.size = 0
+        self.fed = False
+
+    def feed(self, data):
+        """
+        Accept the next chunk of the dump.  Returns False so that
+        python-gnupg does not also buffer the plaintext.
+        """
+        self.fed = True
+        lines = (self.partial+data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.addLine(line)
+        return False
+
+    def addLine(self, line):
+        self.statement.append(line)
+        if not line.endswith(';'):
+            return
+        statement = '\n'.join(self.statement)
+        if not sqlite3.complete_statement(statement):
+            return
+        self.statement = []
+        # the dump's own transaction is replaced by one per batch
+        if statement in ('BEGIN TRANSACTION;', 'COMMIT;'):
+            return
+        self.script.append(statement)
+        self.size += len(statement)
+        if self.size >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.script:
+            self.db.cursor().executescript('BEGIN;\n'+'\n'.join(self.script)+'\nCOMMIT;')
+            self.script = []
+            self.size = 0
+
+    def close(self):
+        if self.partial:
+            self.addLine(self.partial)
+            self.partial = ''
+        self.flush()
+
+def openDB(keys_db,gpg,dbpassphrase,readOnly=False):
+    """
+    Decrypt keys.db into an in-memory database and replay its journal.
+    A read-only database refuses writes and is never written back by
+    closeDB.
+    """
+
+    db = sqlite3.connect(':memory:', factory=KeysDB, check_same_thread=False)
+    loader = DumpLoader(db)
+
+    # python-gnupg versions with on_data hand us the plaintext as gpg
+    # produces it; older versions buffer it and we load it afterwards.
+    on_data = getattr(gpg, 'on_data', None)
+    gpg.on_data = loader.feed
+    try:
+        with open(keys_db, 'rb') as f:
+            sql = gpg.decrypt_file(f, passphrase=dbpassphrase)
+    finally:
+        gpg.on_data = on_data
+    if not sql:
+        print 'Bad passphrase!'
+        sys.exit(1)
+    if not loader.fed:
+        loader.feed(sql.data)
+    loader.close()
+    replayJournal(db,keys_db,gpg,dbpassphrase)
+    db.markClean()
+    migrateDB(db)
+    if readOnly:
+        db.readOnly = True
+        db.execute('PRAGMA query_only = ON')
     return db
 
+def getGeneration(db):
+    """
+    Return the snapshot generation.  Journal records written against an
+    older snapshot are ignored, so a compaction that dies between
+    replacing keys.db and removing the journal is harmless.
+    """
+
+    cur = db.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='journal'")
+    if not cur.fetchone():
+        return 0
+    cur.execute('SELECT Generation FROM journal WHERE Id = 1')
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+def replayJournal(db,keys_db,gpg,dbpassphrase):
+    """
+    Apply the encrypted journal records in keys.db.journal, in order
+    """
+
+    journal = keys_db+'.journal'
+    try:
+        with open(journal, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return
+
+    generation = getGeneration(db)
+    for block in re.findall('-----BEGIN PGP MESSAGE-----.*?-----END PGP MESSAGE-----', data, re.DOTALL):
+        record = gpg.decrypt(block, passphrase=dbpassphrase)
+        try:
+            record = json.loads(record.data)
+        except ValueError:
+            print 'Skipping unreadable keys.db journal record'
+            continue
+        if record['generation'] != generation:
+            continue
+        with db:
+            for statement, params in record['changes']:
+                db.execute(statement, params)
+        db.journalRecords += 1
+
 def closeDB(db,keys_db,gpg,dbpassphrase):
+    """
+    Save the database, unless it was opened read-only or nothing has
+    changed since it was loaded.  Normally the changes are appended to
+    the journal as one small encrypted record; keys.db itself is only
+    rewritten when the journal reaches JOURNAL_MAX records or the whole
+    database has to be re-encrypted (new database, new passphrase).
+    """
+
+    if db.readOnly or not db.isDirty():
+        return
+
+    db.commit()
+    if db.dirty or not os.path.exists(keys_db) or db.journalRecords >= JOURNAL_MAX:
+        writeSnapshot(db,keys_db,gpg,dbpassphrase)
+    elif db.changes:
+        appendJournal(db,keys_db,gpg,dbpassphrase)
+    db.markClean()
+
+def appendJournal(db,keys_db,gpg,dbpassphrase):
+    """
+    Append the committed changes to keys.db.journal as one encrypted record
+    """
 
-    sql = ''
-    for item in db.iterdump():
-        sql = sql+item+'\n'
-    crypt_sql = gpg.encrypt(sql, recipients=None, symmetric=CIPHER,
-                            always_trust=True, passphrase=dbpassphrase)
+    record = json.dumps({'generation': getGeneration(db), 'changes': db.changes})
+    crypt_record = gpg.encrypt(record, recipients=None, symmetric=CIPHER,
+                               always_trust=True, passphrase=dbpassphrase)
+    if not crypt_record.ok:
+        print 'Encryption of keys.db journal failed: %s' % crypt_record.status
+        sys.exit(1)
+
+    journal = keys_db+'.journal'
+    with open(journal, 'ab') as f:
+        f.write(str(crypt_record))
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(journal,0600)
+    db.journalRecords += 1
+
+def writeSnapshot(db,keys_db,gpg,dbpassphrase):
+    """
+    Encrypt the whole database to keys.db and start a new, empty journal.
+    The dump is streamed through gpg into a temporary file, which then
+    replaces keys.db, so a failed encryption never clobbers the old
+    database.
+    """
+
+    with db:
+        db.execute('INSERT OR REPLACE INTO journal (Id, Generation) VALUES(?,?)', (1,getGeneration(db)+1))
+
+    tmp_db = keys_db+'.tmp'
+    crypt_sql = gpg.encrypt_file(DumpReader(db), recipients=None, symmetric=CIPHER,
+                                 always_trust=True, passphrase=dbpassphrase,
+                                 output=tmp_db)
+    if not crypt_sql.ok:
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+        print 'Encryption of keys.db failed: %s' % crypt_sql.status
+        sys.exit(1)
+    os.chmod(tmp_db,0600)
+    os.rename(tmp_db,keys_db)
 
-    with open(keys_db, 'wb') as f:
-        f.write(str(crypt_sql))
+    journal = keys_db+'.journal'
+    if os.path.exists(journal):
+        os.remove(journal)
+    db.journalRecords = 0
 
 if __name__=="__main__":
     """
     Run an example key insertion
     """
-    makeKeys()
-    insertKeys(sys.argv[1], sys.argv[2], sys.argv[3])
-    sharedSecret = genSharedSecret(sys.argv[1], sys.argv[2])
+    import gnupg
+    gpg = gnupg.GPG(gnupghome=HOME, gpgbinary=GPGBINARY, keyring=KEYRING,
+                    secret_keyring=SECRET_KEYRING)
+    dbpassphrase = getpass('Passphrase for keys.db database: ')
+    with session(gpg,dbpassphrase) as store:
+        insertKeys(sys.argv[1], sys.argv[2], sys.argv[3], store)
+        sharedSecret = genSharedSecret(sys.argv[1], sys.argv[2], store)
     print sharedSecret
     print len(sharedSecret)
 
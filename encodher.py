@@ -27,12 +27,22 @@ import sys
 import hsub
 import gnupg
 import dhutils
+import dhbackend
+import agent
 import re
 import time
 import string
 import random
 import email
+import email.utils
+import mailbox
 import nntplib
+import socket
+import nntppool
+import pipeline
+import spool
+import sink
+import multiprocessing
 from getpass import getpass
 from constants import *
 
@@ -47,31 +57,49 @@ except (IndexError):
     print 'Options:'
     print ' --init, -i: initialize keys.db database'
     print ' --import, -m: import signed public key'
+    print ' --import-batch, -j: import a directory or file of signed public keys'
     print ' --mutate-key, -a: mutate DH secret key for PFS'
     print ' --sign-pub, -s: sign your own public key'
     print ' --change-toemail, -t: change toEmail on key'
     print ' --change-fromemail, -f: change fromEmail on key'
     print ' --change-pubkey, -p: change public key for fromEmail -> toEmail'
     print ' --encode-email, -e: symmetrically encode a file for fromEmail -> toEmail'
-    print ' --decode-email, -d: symmetrically decode a file for fromEmail -> toEmail'
+    print ' --decode-email, -d: symmetrically decode a file, maildir or mbox for fromEmail -> toEmail'
     print ' --list-routes, -l: list all routes in database'
     print ' --gen-secret, -c: generate shared secret for fromEmail -> toEmail'
     print ' --gen-key, -n: generate a new key for fromEmail -> toEmail'
     print ' --get-key, -g: get key for fromEmail -> toEmail from database'
     print ' --fetch-aam, -h: fetch messages from alt.anonymous.messages newsgroup'
+    print ' --poll-aam, -w: keep polling alt.anonymous.messages for messages'
     print ' --clone-key, -y: clone key from one route to another'
-    print ' --rollback, -b: roll back the a.a.m last read timestamp'
+    print ' --rollback, -b: roll back a.a.m reading by days or articles'
+    print ' --rescan-spool, -o: look for messages in the local article spool'
     print ' --change-dbkey, -k: change keys.db encryption key'
+    print ' --compact-db, -z: fold the keys.db journal into keys.db'
+    print ' --start-agent, -r: unlock keys.db and serve it to later commands'
+    print ' --stop-agent, -q: save keys.db and stop the agent'
+    print ' --bench-backends, -u: time key generation and shared secrets with each DH backend'
     sys.exit(0)
 
 try:
     with open(KEYS_DB):
-        dbpassphrase = getpass('Passphrase to decrypt keys.db: ')
+        if opt in ('--bench-backends', '-u'):
+            pass # keys.db isn't needed
+        elif agent.connect():
+            dbpassphrase = None # the agent has keys.db unlocked
+        else:
+            dbpassphrase = getpass('Passphrase to decrypt keys.db: ')
 except IOError:
     pass
 
+def noAgent():
+    if agent.connect():
+        print 'The encodher agent is running, stop it first with: '+sys.argv[0]+' --stop-agent'
+        sys.exit(1)
+
 def init():
 
+    noAgent()
     try:
         dhutils.initDB(gpg,dbpassphrase)
         print 'Database already exists.  Only the news timestamp was updated.'
@@ -84,9 +112,14 @@ def rollback():
 
     try:
         days = sys.argv[2]
+        unit = sys.argv[3] if len(sys.argv) > 3 else 'days'
     except (IndexError):
-        print 'You need to supply the number of days to roll back nntp!'
-        print 'Ex: '+sys.argv[0]+' --rollback <# of days>'
+        print 'You need to supply the number of days or articles to roll back nntp!'
+        print 'Ex: '+sys.argv[0]+' --rollback <# of days> [days|articles]'
+        sys.exit(1)
+    if unit not in ('day', 'days', 'article', 'articles'):
+        print 'Roll back by days or articles, not '+unit
+        print 'Ex: '+sys.argv[0]+' --rollback <# of days> [days|articles]'
         sys.exit(1)
 
     try:
@@ -96,7 +129,12 @@ def rollback():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    dhutils.rollback(days,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        if unit.startswith('article'):
+            for host, port in NEWSSERVERS:
+                dhutils.rollbackArticles(days,nntppool.serverName(host,port),NEWSGROUP,store)
+        else:
+            dhutils.rollback(days,store)
 
 def importKey():
 
@@ -127,36 +165,148 @@ def importKey():
         print 'Signature not valid'
         sys.exit(0)
 
-    data = signed_data.split('\n')
+    pubkey = readPubKey(signed_data)
+    toEmail = signerEmail(verified.username)
+    print 'To Email is: %s' % toEmail.lower()
+    fromEmail = raw_input('Enter From Email: ')
+
+    with dhutils.session(gpg,dbpassphrase) as store:
+        keys = store.getKeys(fromEmail.lower(),toEmail.lower())
+
+        if not keys:
+            print 'key doesn\'t exist for the '+fromEmail+' -> '+toEmail+' route'
+            print 'create new key?'
+            ans = raw_input('y/N: ')
+            if ans == 'y':
+                dhutils.insertKeys(fromEmail.lower(),toEmail.lower(),pubkey.lower(),store)
+                dhutils.warnInvalidKey(fromEmail.lower(),toEmail.lower(),store)
+        else:
+            print 'key exists for the '+fromEmail.lower()+' -> '+toEmail.lower()+' route'
+            print 'change key?'
+            ans = raw_input('y/N: ')
+            if ans == 'y':
+                dhutils.changePubKey(fromEmail.lower(),toEmail.lower(),pubkey.lower(),store)
+
+
+def readPubKey(signed_data):
+    """
+    Pull the DH public key out of a signed block made by --sign-pub
+    """
+
     pubkey = ''
-    for line in data:
+    for line in signed_data.split('\n'):
         if len(line) == 50:
             pubkey += line
     while pubkey[:1] == '0':
         pubkey = pubkey[1:]
+    return pubkey
 
+def signerEmail(username):
     try:
-        toEmail = verified.username.split('<')[1].split('>')[0] # regular email
+        return username.split('<')[1].split('>')[0] # regular email
     except IndexError:
-        toEmail = verified.username # only a name - probably anonymous
-    print 'To Email is: %s' % toEmail.lower()
-    fromEmail = raw_input('Enter From Email: ')
+        return username # only a name - probably anonymous
+
+def verifyKey(signed_data):
+    """
+    Verify one signed DH public key.  Runs in an --import-batch worker
+    process, so only plain values are sent back.
+    """
+
+    verified = gpg.verify(signed_data)
+    if verified.username is None:
+        return None, None, None
+    return verified.username, verified.trust_text, readPubKey(signed_data)
+
+def readRouteMap(file_name):
+    """
+    Read an --import-batch mapping file.  Each line is a signer's email
+    (the toEmail of the route) followed by the fromEmail to use with it.
+    Blank lines and lines starting with # are ignored.
+    """
+
+    routeMap = {}
+    with open(file_name, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) != 2:
+                print 'Bad line in '+file_name+': '+line.strip()
+                sys.exit(1)
+            routeMap[fields[0].lower()] = fields[1].lower()
+    return routeMap
+
+def importBatch():
+
+    try:
+        source = sys.argv[2]
+        mapFile = sys.argv[3]
+    except (IndexError):
+        print 'You need to supply a key directory or file, and a mapping file!'
+        print 'Ex: '+sys.argv[0]+' --import-batch <key dir|key file> <mapping file>'
+        sys.exit(1)
+
+    try:
+        with open(KEYS_DB): pass
+    except IOError:
+        print 'No keys database (keys.db)'
+        print 'initialize the database with '+sys.argv[0]+' --init'
+        sys.exit(1)
 
-    keys = dhutils.getKeys(fromEmail.lower(),toEmail.lower(),gpg,dbpassphrase)
+    routeMap = readRouteMap(mapFile)
 
-    if not keys:
-        print 'key doesn\'t exist for the '+fromEmail+' -> '+toEmail+' route'
-        print 'create new key?'
-        ans = raw_input('y/N: ')
-        if ans == 'y':
-            dhutils.insertKeys(fromEmail.lower(),toEmail.lower(),pubkey.lower(),gpg,dbpassphrase)
+    if os.path.isdir(source):
+        files = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+        files = [name for name in files if os.path.isfile(name)]
     else:
-        print 'key exists for the '+fromEmail.lower()+' -> '+toEmail.lower()+' route'
-        print 'change key?'
-        ans = raw_input('y/N: ')
-        if ans == 'y':
-            dhutils.changePubKey(fromEmail.lower(),toEmail.lower(),pubkey.lower(),gpg,dbpassphrase)
+        files = [source]
+    blocks = []
+    for file_name in files:
+        with open(file_name, 'r') as f:
+            blocks += re.findall('-----BEGIN PGP SIGNED MESSAGE-----.*?-----END PGP SIGNATURE-----',
+                                 f.read(), flags=re.DOTALL)
+    if not blocks:
+        print 'No signed keys found in '+source
+        sys.exit(1)
 
+    print 'Verifying %d signed DH public keys' % len(blocks)
+    pool = multiprocessing.Pool()
+    try:
+        results = pool.map(verifyKey, blocks)
+    finally:
+        pool.close()
+        pool.join()
+
+    imports = []
+    for username, trust_text, pubkey in results:
+        if username is None:
+            print 'Signature not valid, skipped'
+            continue
+        toEmail = signerEmail(username).lower()
+        if toEmail not in routeMap:
+            print 'No route for '+username+' in '+mapFile+', skipped'
+            continue
+        if not pubkey:
+            print 'No DH public key in block signed by '+username+', skipped'
+            continue
+        print 'Verified signed by: %s at trust level: %s' % (username, trust_text)
+        imports.append((routeMap[toEmail], toEmail, pubkey.lower()))
+
+    inserted = changed = 0
+    with dhutils.session(gpg,dbpassphrase) as store:
+        for fromEmail, toEmail, pubkey in imports:
+            if store.getKeys(fromEmail,toEmail):
+                store.changePubKey(fromEmail,toEmail,pubkey)
+                print 'Changed key for the '+fromEmail+' -> '+toEmail+' route'
+                changed += 1
+            else:
+                store.insertKeys(fromEmail,toEmail,pubkey)
+                print 'Created key for the '+fromEmail+' -> '+toEmail+' route'
+                inserted += 1
+            dhutils.warnInvalidKey(fromEmail,toEmail,store)
+    print '%d routes created, %d changed, %d blocks skipped' % (inserted, changed,
+                                                                len(blocks)-len(imports))
 
 def sign_pub():
 
@@ -176,7 +326,8 @@ def sign_pub():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    privkey, mypubkey, otherpubkey = dhutils.getKeys(fromEmail,toEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase,readOnly=True) as store:
+        privkey, mypubkey, otherpubkey = store.getKeys(fromEmail,toEmail)
     while len(mypubkey) < 50*50:
         mypubkey = '0'+mypubkey
     brokenkey = [mypubkey[i:i+50] for i in range(0, len(mypubkey), 50)]
@@ -215,7 +366,8 @@ def change_toEmail():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    keys = dhutils.changeToEmail(fromEmail,oldToEmail,newToEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        dhutils.changeToEmail(fromEmail,oldToEmail,newToEmail,store)
 
 
 def change_fromEmail():
@@ -236,7 +388,8 @@ def change_fromEmail():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    keys = dhutils.changeFromEmail(oldFromEmail,newFromEmail,toEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        dhutils.changeFromEmail(oldFromEmail,newFromEmail,toEmail,store)
 
 def change_pub():
     try:
@@ -256,7 +409,8 @@ def change_pub():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    keys = dhutils.changePubKey(fromEmail,toEmail,pubkey,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        dhutils.changePubKey(fromEmail,toEmail,pubkey,store)
 
 def hs():
     try:
@@ -281,7 +435,8 @@ def hs():
     else:
         sendAnon = False
 
-    passphrase = dhutils.genSharedSecret(fromEmail,toEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        passphrase = dhutils.genSharedSecret(fromEmail,toEmail,store)
 
     with open(file_name, "rb") as f:
         msg = gpg.encrypt_file(f, recipients=None, symmetric=CIPHER,
@@ -311,7 +466,51 @@ def hs():
     print 'Passphrase: %s' % passphrase
 
 
+def isMailbox(file_name):
+    if os.path.isdir(file_name):
+        return True
+    with open(file_name, 'r') as f:
+        return f.readline().startswith('From ')
+
+def decodeMailbox(file_name):
+    """
+    Decode every message in a maildir or mbox written by --fetch-aam,
+    using the route in each message's X-encoDHer-Route header
+    """
+
+    if os.path.isdir(file_name):
+        box = mailbox.Maildir(file_name, factory=None)
+    else:
+        box = mailbox.mbox(file_name)
+    passphrases = {}
+    with dhutils.session(gpg,dbpassphrase) as store:
+        for key in sorted(box.keys()):
+            message = box[key]
+            route = message.get('X-encoDHer-Route')
+            if not route:
+                print '\nNo X-encoDHer-Route header, skipping message '+key
+                continue
+            fromEmail, toEmail = route.strip().split('->')
+            if route not in passphrases:
+                passphrases[route] = dhutils.genSharedSecret(toEmail,fromEmail,store)
+            print '\nMail for: '+toEmail+' from '+fromEmail
+            msg = gpg.decrypt(message.as_string(), passphrase=passphrases[route],
+                              always_trust=True)
+            if not msg:
+                print 'Bad shared secret!'
+                continue
+            print '\n'+unicode(msg)
+    box.close()
+
 def hsd():
+    # A maildir or mbox from --fetch-aam: decode all of it.
+    try:
+        if len(sys.argv) == 3 and isMailbox(sys.argv[2]):
+            decodeMailbox(sys.argv[2])
+            sys.exit(0)
+    except IOError:
+        pass
+
     # Try getting the route info from the X-encoDHer-Route header.
     # If the header doesn't exist, pass and parse the normal way.
     try:
@@ -320,7 +519,8 @@ def hsd():
             header = f.readline().split(': ')
             if header[0] == 'X-encoDHer-Route':
                 route = header[1].strip().split('->')
-                passphrase = dhutils.genSharedSecret(route[1],route[0],gpg,dbpassphrase)
+                with dhutils.session(gpg,dbpassphrase) as store:
+                    passphrase = dhutils.genSharedSecret(route[1],route[0],store)
                 msg = gpg.decrypt_file(f, passphrase=passphrase, always_trust=True)
                 if not msg:
                     print 'Bad shared secret!'
@@ -349,8 +549,9 @@ def hsd():
         sys.exit(1)
 
     base, ext = os.path.splitext(file_name)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        passphrase = dhutils.genSharedSecret(toEmail,fromEmail,store)
     with open(file_name, "r") as f:
-        passphrase = dhutils.genSharedSecret(toEmail,fromEmail,gpg,dbpassphrase)
         msg = gpg.decrypt_file(f, passphrase=passphrase, always_trust=True)
         if not msg:
             print 'Bad shared secret!'
@@ -367,7 +568,8 @@ def list_keys():
         sys.exit(1)
 
     print 'Listing of all routes in database:'
-    dhutils.listKeys(gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase,readOnly=True) as store:
+        dhutils.listKeys(store)
 
 def secret():
     try:
@@ -385,7 +587,8 @@ def secret():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    sharedSecret = dhutils.genSharedSecret(fromEmail,toEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        sharedSecret = dhutils.genSharedSecret(fromEmail,toEmail,store)
     print 'Secret: ',sharedSecret
 
 def gen():
@@ -404,8 +607,8 @@ def gen():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    dhutils.makeKeys()
-    dhutils.insertKeys(fromEmail,toEmail,1,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        dhutils.insertKeys(fromEmail,toEmail,1,store)
 
 
 def get():
@@ -424,7 +627,8 @@ def get():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    privkey, mypubkey, otherpubkey = dhutils.getKeys(fromEmail,toEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase,readOnly=True) as store:
+        privkey, mypubkey, otherpubkey = store.getKeys(fromEmail,toEmail)
     print fromEmail+' Public Key: ', mypubkey
     print toEmail+' Public Key: ', otherpubkey
 
@@ -444,7 +648,8 @@ def delete():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    dhutils.deleteKey(fromEmail,toEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        store.deleteKey(fromEmail,toEmail)
 
 def mutate():
     try:
@@ -462,10 +667,11 @@ def mutate():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    oldpassphrase = dhutils.genSharedSecret(fromEmail,toEmail,gpg,dbpassphrase)
-    dhutils.mutateKey(fromEmail,toEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        oldpassphrase = dhutils.genSharedSecret(fromEmail,toEmail,store)
+        dhutils.mutateKey(fromEmail,toEmail,store)
 
-    privkey, mypubkey, otherpubkey = dhutils.getKeys(fromEmail,toEmail,gpg,dbpassphrase)
+        privkey, mypubkey, otherpubkey = store.getKeys(fromEmail,toEmail)
     while len(mypubkey) < 50*50:
         mypubkey = '0'+mypubkey
     brokenkey = [mypubkey[i:i+50] for i in range(0, len(mypubkey), 50)]
@@ -503,52 +709,394 @@ def mutate():
         print 'New key encrypted with old DH shared secret is in "mutatedkey.asc"'
         print 'Get unencrypted, signed copy of new key with '+sys.argv[0]+' --sign-pub '+fromEmail+' '+toEmail
 
+def postedSince(date, timeStamp):
+    """
+    True if an article Date header is at or after timeStamp.  Articles
+    with a missing or unreadable date are treated as new.
+    """
+
+    parsed = email.utils.parsedate_tz(date)
+    if parsed is None:
+        return True
+    return email.utils.mktime_tz(parsed) >= timeStamp
+
+def scanOverview(server, first, last, timeStamp=None):
+    """
+    Return (article number, Message-ID, Subject) for the articles in
+    first..last, from the overview database.  The range is read newest
+    first, OVER_CHUNK articles at a time.  Given a timeStamp, only the
+    articles posted since then are returned, and the scan stops at the
+    first chunk that holds nothing new.
+    """
+
+    articles = []
+    end = last
+    while end >= first:
+        start = max(first, end-OVER_CHUNK+1)
+        resp, items = server.xover(str(start), str(end))
+        new = [(number, message_id, subject) for
+               number, subject, poster, date, message_id, refs, size, lines in items
+               if timeStamp is None or postedSince(date, timeStamp)]
+        if items and not new:
+            break
+        articles = new+articles
+        end = start-1
+    return articles
+
+def scanHeads(pool, ids):
+    """
+    For servers without an overview database: read only the headers of
+    the articles in ids (Message-IDs or article numbers), through the
+    connection pool.
+    """
+
+    articles = []
+    for head in pool.map('head', ids):
+        if head is None:
+            continue # no such message (maybe it was deleted?)
+        resp, number, message_id, lines = head
+        headers = email.message_from_string(string.join(lines, "\n"))
+        articles.append((message_id, message_id, headers.get('Subject', '')))
+    return articles
+
+def scanAAM(server, pool, timeStamp, highWater=None):
+    """
+    List the a.a.m articles after article number highWater without
+    fetching any article bodies.  Without a high-water mark, or if the
+    server has renumbered the group, list those posted since timeStamp
+    instead.  Returns the articles and the group's last article number.
+    """
+
+    resp, count, first, last, name = server.group(NEWSGROUP)
+    first, last = int(first), int(last)
+    if highWater is not None and highWater <= last:
+        first = max(first, highWater+1)
+        try:
+            return scanOverview(server, first, last), last
+        except nntplib.error_perm:
+            return scanHeads(pool, [str(n) for n in range(first, last+1)]), last
+
+    try:
+        return scanOverview(server, first, last, timeStamp), last
+    except nntplib.error_perm:
+        YYMMDD = time.strftime('%y%m%d', time.gmtime(timeStamp))
+        HHMMSS = time.strftime('%H%M%S', time.gmtime(timeStamp))
+        resp, ids = server.newnews(NEWSGROUP, YYMMDD, HHMMSS)
+        return scanHeads(pool, ids), last
+
+def matchArticles(articles, passphrases):
+    """
+    The hsub match stage of --fetch-aam: return (article, Message-ID,
+    passphrase) for every article whose Subject is an hsub of one of our
+    shared secrets.
+    """
+
+    routes = hsub.match_many([subject for article, message_id, subject in articles],
+                             [(passphrase, passphrase[2][:16]) for passphrase in passphrases])
+    return [(article, message_id, routes[subject]) for article, message_id, subject in articles
+            if subject in routes]
+
+def decryptArticle(n, fetched):
+    """
+    The decrypt stage of --fetch-aam: decrypt a fetched article that
+    matched one of our routes.  Returns the fetched tuple with the
+    decrypted message and the article text (or None, None) added.
+    """
+
+    article, message_id, passphrase, reply, source = fetched
+    if reply is None or passphrase is None:
+        return fetched+(None, None)
+    resp, number, message_id, text = reply
+    message = email.message_from_string(string.join(text, "\n"))
+    msg = gpg.decrypt(message.as_string(), passphrase=passphrase[2],
+                      always_trust=True)
+    return fetched+(msg, message.as_string()+'\n')
+
+def readMessages(results, store, messageSink, articleSpool=None, interactive=True,
+                 unreachable=()):
+    """
+    Store the output of the decrypt stage in messageSink, in article
+    order, spooling the articles fetched from a news server (source) if
+    there is a spool.  The decrypted text is printed only when
+    interactive and storing to files; when not interactive, a bad
+    shared secret is reported rather than fatal.  Returns the Message-IDs
+    of the messages for us that could not be fetched because of a
+    server error (those in unreachable), rather than because they are
+    gone.
+    """
+
+    failed = []
+    for article, message_id, passphrase, reply, source, msg, text in results:
+        if reply is None:
+            if passphrase is not None and message_id in unreachable:
+                print '\nCould not fetch '+message_id+' for '+passphrase[0]+' from '+passphrase[1]+ \
+                      ', it will be tried again on the next fetch'
+                failed.append(message_id)
+            continue # no such message (maybe it was deleted?)
+        if source and articleSpool:
+            articleSpool.add(source, NEWSGROUP, reply[1], message_id, reply[3])
+        if passphrase is None:
+            continue
+        print '\nMail for: '+passphrase[0]+' from '+passphrase[1]
+        if not msg:
+            print 'Bad shared secret!'
+            if interactive:
+                sys.exit(1)
+            continue
+        if interactive and messageSink.kind == 'file':
+            print '\n'+unicode(msg)
+        print 'encrypted message stored in '+messageSink.add(passphrase, message_id, text)
+        store.addSeen(message_id)
+    messageSink.flush()
+    return failed
+
+def unseenMatches(articles, passphrases, store):
+    """
+    Match articles against our routes, leaving out the messages we have
+    already decrypted, e.g. after a --rollback.  Returns a dict of
+    Message-ID to passphrase.
+    """
+
+    matches = matchArticles(articles, passphrases)
+    seen = set(store.getSeen([message_id for article, message_id, passphrase in matches]))
+    return dict((message_id, passphrase) for article, message_id, passphrase in matches
+                if message_id not in seen)
+
+def newsServers():
+    return [nntppool.NewsServer(host, port, NEWSGROUP) for host, port in NEWSSERVERS]
+
+def fetchAAM(servers, store, passphrases, messageSink, articleSpool=None,
+             interactive=True):
+    """
+    One pass over a.a.m: scan every news server for new articles, then
+    fetch, decrypt and store the ones for our routes in messageSink, and move each
+    server's high-water mark on.  An article carried by several servers
+    is only matched and fetched once, from whichever server listed it
+    first.  A server's high-water mark stops short of any article of ours
+    that no server could deliver because of an error, so the next pass
+    tries it again; articles that have been cancelled or have expired
+    are skipped.  Returns the number of servers that could be scanned.
+    """
+
+    timeStamp, curTimeStamp = store.getNewsTimestamp()
+    highWaters = [(news, store.getHighWater(news.name,NEWSGROUP)) for news in servers]
+
+    def scan(n, server):
+        news, highWater = server
+        try:
+            articles, last = scanAAM(news.connect(), news.pool, timeStamp, highWater)
+            return time.time(), news, highWater, articles, last
+        except (socket.error, EOFError, nntplib.NNTPError) as e:
+            print news.name+' news server error: %s' % (str(e) or e.__class__.__name__)
+            news.close()
+            return None
+
+    # Message-IDs that at least one server failed to deliver, as opposed
+    # to ones no server has any more
+    unreachable = set()
+
+    def fetchArticle(n, job):
+        sources, message_id, passphrase, reply = job
+        if reply is not None:
+            return job+(None,)
+        # fall back to the other servers that listed it
+        for news, article in sources:
+            try:
+                reply = news.pool.fetch(n, 'article', article)
+            except nntppool.FetchError:
+                unreachable.add(message_id)
+                continue
+            if reply is not None:
+                return (sources, message_id, passphrase, reply, news.name)
+        return job+(None,)
+
+    # scan the servers side by side, one thread each, and merge the
+    # results by Message-ID in the order the scans finished
+    scans = [result for result in pipeline.imap(scan, highWaters, len(servers)) if result]
+    scans.sort(key=lambda result: result[0])
+    articles = []
+    sources = {}
+    for finished, news, highWater, listed, last in scans:
+        for article, message_id, subject in listed:
+            if message_id not in sources:
+                sources[message_id] = []
+                articles.append((article, message_id, subject))
+            sources[message_id].append((news, article))
+
+    # match on the Subject alone, and only download the articles that are ours,
+    # plus, with a spool, the ones it doesn't have yet.  Fetching and decrypting
+    # run as a pipeline, so the two overlap.
+    matches = unseenMatches(articles, passphrases, store)
+    jobs = []
+    if articleSpool:
+        spooled = articleSpool.has([message_id for article, message_id, subject in articles])
+    for article, message_id, subject in articles:
+        passphrase = matches.get(message_id)
+        if articleSpool and message_id in spooled:
+            if passphrase:
+                reply = (None, article, message_id, articleSpool.get(message_id))
+                jobs.append((sources[message_id], message_id, passphrase, reply))
+        elif passphrase or articleSpool:
+            jobs.append((sources[message_id], message_id, passphrase, None))
+
+    fetched = pipeline.imap(fetchArticle, jobs, NNTP_CONNECTIONS)
+    decrypted = pipeline.imap(decryptArticle, fetched, DECRYPT_WORKERS)
+    try:
+        failed = readMessages(decrypted, store, messageSink, articleSpool, interactive,
+                              unreachable)
+    finally:
+        # if readMessages stopped early, wait for both stages' threads
+        # before the caller closes the connections they are using
+        decrypted.close()
+        fetched.close()
+    if articleSpool:
+        articleSpool.expire()
+
+    # nothing is written when no group has moved, so an idle poll
+    # doesn't touch keys.db
+    moved = False
+    for finished, news, highWater, listed, last in scans:
+        retry = [int(article) for message_id in failed
+                 for source, article in sources[message_id] if source is news]
+        if retry:
+            last = min(last, min(retry)-1)
+        if last != highWater:
+            store.setHighWater(news.name,NEWSGROUP,last)
+            moved = True
+    if moved:
+        store.setNewsTimestamp(curTimeStamp)
+    store.expireSeen(curTimeStamp-SEEN_DAYS*86400)
+    return len(scans)
+
 def aam():
-    GROUP  = "alt.anonymous.messages"
 
-    timeStamp, curTimeStamp = dhutils.getNewsTimestamp(gpg,dbpassphrase)
-    YYMMDD = time.strftime('%y%m%d', time.gmtime(timeStamp))
-    HHMMSS = time.strftime('%H%M%S', time.gmtime(timeStamp))
+    with dhutils.session(gpg,dbpassphrase) as store:
+        passphrases = dhutils.getListOfKeys(store)
+
+        servers = newsServers()
+        messageSink = sink.openSink()
+        articleSpool = spool.Spool() if SPOOL else None
+        try:
+            if not fetchAAM(servers, store, passphrases, messageSink, articleSpool):
+                print 'Could not reach any news server.'
+                sys.exit(1)
+        finally:
+            for news in servers:
+                news.close()
+            messageSink.close()
+            if articleSpool:
+                articleSpool.close()
+    print 'End of messages.'
 
-    passphrases = dhutils.getListOfKeys(gpg,dbpassphrase)
+def pollAAM():
 
-    # connect to server
-    server = nntplib.NNTP(NEWSSERVER,NEWSPORT)
+    try:
+        with open(KEYS_DB): pass
+    except IOError:
+        print 'No keys database (keys.db)'
+        print 'initialize the database with '+sys.argv[0]+' --init'
+        sys.exit(1)
 
-    server.newnews(GROUP, YYMMDD, HHMMSS, '.newnews')
+    try:
+        interval = float(sys.argv[2])
+    except IndexError:
+        interval = POLL_INTERVAL
+    except ValueError:
+        print 'Poll interval must be a number of seconds.'
+        print 'Ex: '+sys.argv[0]+' --poll-aam [<seconds>]'
+        sys.exit(1)
+
+    if SINK == 'file':
+        if not os.path.exists(MESSAGE_DIR):
+            os.makedirs(MESSAGE_DIR, 0700)
+        destination = MESSAGE_DIR
+    else:
+        destination = MAILBOX
+    print 'Polling '+NEWSGROUP+' every %g seconds, messages go to %s' % (interval, destination)
+
+    # keys.db, the derived secrets and the news server connections all
+    # stay open between polls.  The routes are only reloaded when another
+    # command changes keys.db, and each poll only saves the new
+    # high-water marks and Message-IDs (a journal record, see closeDB),
+    # on top of whatever other commands saved during the poll.
+    servers = newsServers()
+    messageSink = sink.openSink(messageDir=MESSAGE_DIR)
+    articleSpool = spool.Spool() if SPOOL else None
+    delay = interval
+    try:
+        with dhutils.session(gpg,dbpassphrase) as store:
+            passphrases = dhutils.getListOfKeys(store)
+            try:
+                while True:
+                    if store.refresh():
+                        passphrases = dhutils.getListOfKeys(store)
+                    # servers that fail are reconnected on the next poll; while
+                    # none of them answer, back off
+                    if fetchAAM(servers, store, passphrases, messageSink, articleSpool,
+                                interactive=False):
+                        delay = interval
+                    else:
+                        delay = min(delay*2, POLL_MAX_DELAY)
+                    store.save()
+                    time.sleep(delay)
+            except KeyboardInterrupt:
+                # a poll may have been cut short after storing messages, so
+                # keep their Message-IDs, or they are stored again next time
+                messageSink.flush()
+                store.save()
+                raise
+    except KeyboardInterrupt:
+        print 'Stopped polling.'
+    finally:
+        for news in servers:
+            news.close()
+        messageSink.close()
+        if articleSpool:
+            articleSpool.close()
+
+def rescanSpool():
+
+    try:
+        with open(KEYS_DB): pass
+    except IOError:
+        print 'No keys database (keys.db)'
+        print 'initialize the database with '+sys.argv[0]+' --init'
+        sys.exit(1)
 
-    with open ('.newnews', "r") as f:
-        ids=f.read().splitlines()
+    if not os.path.exists(SPOOL_DB):
+        print 'No article spool, set SPOOL in constants.py and run '+sys.argv[0]+' --fetch-aam'
+        sys.exit(1)
 
-        for msg_id in ids:
+    with dhutils.session(gpg,dbpassphrase) as store:
+        passphrases = dhutils.getListOfKeys(store)
+        if len(sys.argv) > 2:
             try:
-                resp, number, message_id, text = server.article(msg_id)
-            except (nntplib.error_temp, nntplib.error_perm):
-                pass # no such message (maybe it was deleted?)
-            text = string.join(text, "\n")
-
-            message = email.message_from_string(text)
-            match = False
-
-            for passphrase in passphrases:
-                for label, item in message.items():
-                    if label == 'Subject':
-                        match = hsub.check(passphrase[2][:16],item)
-                        #if match, decrypt
-                        if match:
-                            print '\nMail for: '+passphrase[0]+' from '+passphrase[1]
-                            msg = gpg.decrypt(message.as_string(), passphrase=passphrase[2],
-                                              always_trust=True)
-                            if not msg:
-                                print 'Bad shared secret!'
-                                sys.exit(1)
-                            print '\n'+unicode(msg)
-                            with open('message_'+message_id[1:6]+'.txt', "w") as f:
-                                f.write('X-encoDHer-Route: '+passphrase[1]+'->'+passphrase[0]+'\n')
-                                f.write(message.as_string()+'\n')
-                                print 'encrypted message stored in message_'+message_id[1:6]+'.txt'
-
-    dhutils.setNewsTimestamp(curTimeStamp,gpg,dbpassphrase)
+                fromEmail = sys.argv[2]
+                toEmail = sys.argv[3]
+            except (IndexError):
+                print 'You need to supply both fromEmail and toEmail, or neither!'
+                print 'Ex: '+sys.argv[0]+' --rescan-spool [<fromEmail> <toEmail>]'
+                sys.exit(1)
+            passphrases = [passphrase for passphrase in passphrases
+                           if passphrase[:2] == (fromEmail, toEmail)]
+            if not passphrases:
+                print 'Matching key not found.'
+                sys.exit(1)
+
+        articleSpool = spool.Spool()
+        messageSink = sink.openSink()
+        try:
+            articles = articleSpool.subjects()
+            print 'Scanning %d spooled articles' % len(articles)
+            matches = unseenMatches(articles, passphrases, store)
+            jobs = [(article, message_id, matches[message_id],
+                     (None, article, message_id, articleSpool.get(message_id)), None)
+                    for article, message_id, subject in articles if message_id in matches]
+            readMessages(pipeline.imap(decryptArticle, jobs, DECRYPT_WORKERS), store,
+                         messageSink)
+        finally:
+            messageSink.close()
+            articleSpool.close()
     print 'End of messages.'
 
 def clone():
@@ -569,13 +1117,86 @@ def clone():
         print 'initialize the database with '+sys.argv[0]+' --init'
         sys.exit(1)
 
-    dhutils.cloneKey(fromEmail,toEmail,newFromEmail,newToEmail,gpg,dbpassphrase)
+    with dhutils.session(gpg,dbpassphrase) as store:
+        dhutils.cloneKey(fromEmail,toEmail,newFromEmail,newToEmail,store)
 
 def changeDBKey():
 
+    noAgent()
     dhutils.changeDBKey(KEYS_DB,gpg,dbpassphrase)
     print 'Key changed'
 
+def compactDB():
+
+    try:
+        with open(KEYS_DB): pass
+    except IOError:
+        print 'No keys database (keys.db)'
+        print 'initialize the database with '+sys.argv[0]+' --init'
+        sys.exit(1)
+
+    noAgent()
+    dhutils.compactDB(KEYS_DB,gpg,dbpassphrase)
+
+def startAgent():
+
+    try:
+        with open(KEYS_DB): pass
+    except IOError:
+        print 'No keys database (keys.db)'
+        print 'initialize the database with '+sys.argv[0]+' --init'
+        sys.exit(1)
+
+    if agent.connect():
+        print 'The encodher agent is already running.'
+        sys.exit(0)
+
+    try:
+        idleTimeout = float(sys.argv[2])
+    except IndexError:
+        idleTimeout = AGENT_TIMEOUT
+    except ValueError:
+        print 'Idle timeout must be a number of seconds.'
+        print 'Ex: '+sys.argv[0]+' --start-agent [<idle seconds>]'
+        sys.exit(1)
+
+    agent.serve(gpg,dbpassphrase,idleTimeout=idleTimeout,detach=True)
+
+def stopAgent():
+
+    client = agent.connect()
+    if not client:
+        print 'The encodher agent is not running.'
+        sys.exit(0)
+    client.stop()
+    print 'encodher agent stopped'
+
+def benchBackends():
+
+    try:
+        rounds = int(sys.argv[2])
+    except IndexError:
+        rounds = 3
+    except ValueError:
+        print 'Ex: '+sys.argv[0]+' --bench-backends [<rounds>]'
+        sys.exit(1)
+
+    try:
+        print 'Selected DH backend: '+dhbackend.choose().name
+    except dhbackend.BackendError as e:
+        print 'No DH backend selected: %s' % e
+    for backend in dhbackend.BACKENDS:
+        print '\n'+backend.name+': '+backend.description
+        try:
+            capabilities = backend.capabilities()
+            keygen, derive = dhbackend.bench(backend, rounds)
+        except Exception as e:
+            print '  not available: %s' % (str(e) or e.__class__.__name__)
+            continue
+        print '  group %(groupBits)d bits, private exponent %(exponentBits)s bits, ' \
+              'subgroup check: %(checksSubgroup)s, arithmetic: %(arithmetic)s' % capabilities
+        print '  key generation %.3f s, shared secret %.3f s' % (keygen, derive)
+
 def errhandler():
     print 'Invalid option, try again!'
     print 'Execute '+sys.argv[0]+' to get a list of options.'
@@ -585,6 +1206,8 @@ options = { '--init'   : init,
   '-i'   : init,
   '--import' : importKey,
   '-m' : importKey,
+  '--import-batch' : importBatch,
+  '-j' : importBatch,
   '--sign-pub' : sign_pub,
   '-s' : sign_pub,
   '--change-toemail' : change_toEmail,
@@ -611,12 +1234,24 @@ options = { '--init'   : init,
   '-a' : mutate,
   '--fetch-aam' : aam,
   '-h' : aam,
+  '--poll-aam' : pollAAM,
+  '-w' : pollAAM,
   '--clone-key' : clone,
   '-y' : clone,
   '--rollback' : rollback,
   '-b' : rollback,
+  '--rescan-spool' : rescanSpool,
+  '-o' : rescanSpool,
   '--change-dbkey' : changeDBKey,
-  '-k' : changeDBKey
+  '-k' : changeDBKey,
+  '--compact-db' : compactDB,
+  '-z' : compactDB,
+  '--start-agent' : startAgent,
+  '-r' : startAgent,
+  '--stop-agent' : stopAgent,
+  '-q' : stopAgent,
+  '--bench-backends' : benchBackends,
+  '-u' : benchBackends
 }
 
 def main():
@@ -16,8 +16,13 @@
 
 from hashlib import sha256
 from os import urandom
+from time import time
+import multiprocessing
 
 HSUBLEN = 48
+# Below this many subject x secret checks, match_many doesn't bother
+# starting a process pool.
+POOL_CHECKS = 100000
 
 def hash(text, iv = None, hsublen = HSUBLEN):
     """Create an hSub (Hashed Subject). This is constructed as:
@@ -64,6 +69,87 @@ def hexiv(hsub, digits = 16):
         return False
     return iv
 
+def parse(hsub):
+    """Split a Subject into (iv, hex hash) if it could be an hSub, with the
+    same bounds check() applies, otherwise return None."""
+    if len(hsub) < 48 or len(hsub) > 80: return None
+    iv = hexiv(hsub)
+    if not iv: return None
+    return iv, hsub[16:]
+
+def match_many(subjects, secrets, processes = None):
+    """Check many Subjects against many secrets at once.  secrets is a
+    list of (route, text) pairs, where text is what would be passed to
+    check().  Returns a dict mapping each matching Subject to the route
+    of the first secret it matches.  Subjects that can't be hSubs are
+    dropped before any hashing, and each IV is decoded only once.  The
+    checks are split across processes worker processes; by default a
+    pool is only started for batches of POOL_CHECKS checks or more."""
+    parsed = []
+    for subject in set(subjects):
+        hsub = parse(subject)
+        if hsub: parsed.append((subject, hsub[0], hsub[1]))
+    secrets = list(secrets)
+    if processes is None:
+        if len(parsed) * len(secrets) < POOL_CHECKS: processes = 1
+        else: processes = multiprocessing.cpu_count()
+    if processes == 1:
+        return _match_chunk((parsed, secrets))
+    size = len(parsed) // processes + 1
+    chunks = [(parsed[i:i + size], secrets) for i in range(0, len(parsed), size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_match_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    matches = {}
+    for result in results:
+        matches.update(result)
+    return matches
+
+def _match_chunk(args):
+    """The match_many worker.  Hashes the IV once per Subject and copies
+    that state for each secret."""
+    parsed, secrets = args
+    matches = {}
+    for subject, iv, digest in parsed:
+        ivhash = sha256(iv)
+        for route, text in secrets:
+            h = ivhash.copy()
+            h.update(text)
+            if h.hexdigest().startswith(digest):
+                matches[subject] = route
+                break
+    return matches
+
+def benchmark(subjects = 20000, secrets = 20):
+    """Time match_many against a check() loop over the same batch, and
+    print the throughput of each in checks per second."""
+    keys = [(i, urandom(8).encode('hex')) for i in range(secrets)]
+    batch = [hash(urandom(8).encode('hex')) for i in range(subjects)]
+    # a few Subjects that match, and a few that aren't hSubs at all
+    batch[::1000] = [hash(keys[-1][1]) for i in batch[::1000]]
+    batch[1::1000] = ['Re: no hsub here' for i in batch[1::1000]]
+    checks = subjects * secrets
+
+    start = time()
+    slow = {}
+    for subject in batch:
+        for route, text in keys:
+            if check(text, subject):
+                slow[subject] = route
+                break
+    elapsed = time() - start
+    print "check():       %8d checks/s" % (checks / elapsed)
+
+    for processes in sorted(set((1, multiprocessing.cpu_count(), 4))):
+        start = time()
+        fast = match_many(batch, keys, processes)
+        elapsed = time() - start
+        print "match_many(), %d process(es): %8d checks/s" % (processes, checks / elapsed)
+        assert fast == slow
+
 def main():
     """Only used for testing purposes.  We Generate an hSub and then check it
     using the same input text."""
@@ -81,4 +167,5 @@ def main():
 # Call main function.
 if (__name__ == "__main__"):
     main()
+    benchmark()
 
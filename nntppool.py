@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+encoDHer - a python package for symmetric encryption of email
+using the Diffie-Hellman shared secret key protocol.
+
+Copyright (C) 2013 by David R. Andersen
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, see https://github.com/rxcomm/encoDHer
+
+A small pool of NNTP connections for fetching many articles or headers
+at once.  Each connection belongs to one worker thread, since an
+nntplib.NNTP object can only run one command at a time.  Connections
+are made by the connect callable, so the pool can be pointed at a
+local stand-in server.
+"""
+import sys
+import time
+import random
+import socket
+import threading
+import nntplib
+import pipeline
+from constants import *
+
+# "no such article" replies, which retrying will not fix
+NO_ARTICLE = ('423', '430')
+
+class FetchError(nntplib.NNTPError):
+    """
+    Raised when a command still fails after all its retries, as opposed
+    to an article that the server doesn't have
+    """
+    pass
+
+class NNTPPool(object):
+
+    def __init__(self, size=NNTP_CONNECTIONS, group=None, connect=None,
+                 retries=NNTP_RETRIES, retryDelay=NNTP_RETRY_DELAY):
+        self.size = size
+        self.group = group
+        self.connect = connect or (lambda: nntplib.NNTP(NEWSSERVER,NEWSPORT))
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.connections = [None]*size
+
+    def imap(self, command, args):
+        """
+        Run an NNTP command (e.g. 'article' or 'head') once for each
+        item in args, at most size at a time, and yield the replies in
+        the order of args.  Articles that don't exist come back as None;
+        if one can't be fetched after retries attempts, FetchError is
+        raised.
+        """
+
+        return pipeline.imap(lambda n, arg: self.fetch(n, command, arg), args, self.size)
+
+    def map(self, command, args):
+        return list(self.imap(command, args))
+
+    def fetch(self, n, command, arg):
+        """
+        Run one command on connection n.  A temporary failure is retried,
+        and a broken connection is replaced, up to retries times, then
+        FetchError is raised.  Returns None if the article doesn't exist
+        or the command is refused.
+        """
+
+        for attempt in range(self.retries+1):
+            if attempt:
+                time.sleep(self.retryDelay)
+            try:
+                if self.connections[n] is None:
+                    self.connections[n] = self.open()
+                return getattr(self.connections[n], command)(arg)
+            except nntplib.error_perm:
+                return None
+            except nntplib.error_temp as e:
+                if str(e)[:3] in NO_ARTICLE:
+                    return None
+                error = e
+                self.drop(n)
+            except (socket.error, EOFError, nntplib.error_proto) as e:
+                error = e
+                self.drop(n)
+        raise FetchError('%s %s failed after %d attempts: %s' % (
+            command, arg, self.retries+1, str(error) or error.__class__.__name__))
+
+    def open(self):
+        server = self.connect()
+        if self.group:
+            server.group(self.group)
+        return server
+
+    def drop(self, n):
+        server, self.connections[n] = self.connections[n], None
+        if server is not None:
+            try:
+                server.quit()
+            except (socket.error, EOFError, nntplib.NNTPError):
+                pass
+
+    def close(self):
+        for n in range(self.size):
+            self.drop(n)
+
+def serverName(host, port):
+    """
+    The name a news server's high-water marks are kept under.  It
+    includes the port, since several servers are often reached through
+    tunnels on the same host.
+    """
+
+    return '%s:%d' % (host, port)
+
+class NewsServer(object):
+    """
+    One news server for --fetch-aam: a main connection for GROUP and
+    the overview scan, and a pool of connections for fetching articles.
+    """
+
+    def __init__(self, host, port, group, size=NNTP_CONNECTIONS, connect=None):
+        self.name = serverName(host, port)
+        self.connectServer = connect or (lambda: nntplib.NNTP(host, port))
+        self.pool = NNTPPool(size, group, connect=self.connectServer)
+        self.server = None
+
+    def connect(self):
+        if self.server is None:
+            self.server = self.connectServer()
+        return self.server
+
+    def close(self):
+        server, self.server = self.server, None
+        if server is not None:
+            try:
+                server.quit()
+            except (socket.error, EOFError, nntplib.NNTPError):
+                pass
+        self.pool.close()
+
+class FakeNNTP(object):
+    """
+    A stand-in connection for selfTest.  article(arg) answers after a
+    random delay, and the first time arg is asked for it fails the way
+    arg says: 'busy' (400), 'gone' (430), 'perm' (502) or 'broken'
+    (the connection drops for good).  'down' fails every time.
+    Everything is counted in log.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.log['connects'] += 1
+        self.broken = False
+
+    def count(self, key):
+        with self.log['lock']:
+            self.log[key] = self.log.get(key, 0)+1
+            return self.log[key]
+
+    def group(self, name):
+        return '211 1 1 1 '+name
+
+    def article(self, arg):
+        time.sleep(random.random()*0.01)
+        if self.broken:
+            raise socket.error('connection reset')
+        if arg == 'down':
+            self.count(arg)
+            raise nntplib.error_temp('400 server busy')
+        if self.count(arg) == 1:
+            if arg == 'busy':
+                raise nntplib.error_temp('400 server busy')
+            elif arg == 'broken':
+                self.broken = True
+                raise socket.error('connection reset')
+        if arg == 'gone':
+            raise nntplib.error_temp('430 no such article')
+        elif arg == 'perm':
+            raise nntplib.error_perm('502 access denied')
+        return ('220 0 <%s@fake>' % arg, '0', '<%s@fake>' % arg, [arg])
+
+    def quit(self):
+        self.count('quits')
+
+def selfTest(size=4):
+    """
+    Run a batch of articles through a pool of FakeNNTP connections and
+    check the retries, the missing articles and the order of the
+    replies.  Returns False on any mismatch.
+    """
+    log = {'lock': threading.Lock(), 'connects': 0}
+    pool = NNTPPool(size, 'alt.test', connect=lambda: FakeNNTP(log), retryDelay=0)
+    args = [str(i) for i in range(50)]
+    args[3:3] = ['busy', 'gone', 'perm', 'broken']
+    try:
+        replies = pool.map('article', args)
+        try:
+            pool.map('article', ['down'])
+            gaveUp = False
+        except FetchError:
+            gaveUp = True
+    finally:
+        pool.close()
+    expected = [None if arg in ('gone', 'perm') else arg for arg in args]
+    checks = [('replies in order', [reply and reply[3][0] for reply in replies] == expected),
+              ('error_temp retried', log.get('busy') == 2),
+              ('430 not retried', log.get('gone') == 1),
+              ('error_perm not retried', log.get('perm') == 1),
+              ('FetchError after retries', gaveUp and log.get('down') == pool.retries+1),
+              ('reconnect after socket.error', log.get('broken') == 2 and
+               log['connects'] == log.get('quits'))]
+    for name, match in checks:
+        print '%-30s %s' % (name, 'ok' if match else 'MISMATCH')
+    return all(match for name, match in checks)
+
+if __name__ == '__main__':
+    """
+    Self-test the pool against a fake server
+    """
+
+    sys.exit(0 if selfTest() else 1)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+encoDHer - a python package for symmetric encryption of email
+using the Diffie-Hellman shared secret key protocol.
+
+Copyright (C) 2013 by David R. Andersen
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, see https://github.com/rxcomm/encoDHer
+
+Pipeline stages for --fetch-aam.  Each stage is an imap over the
+output of the one before it, running on its own worker threads with
+bounded queues in between, so the network fetches and the gpg
+subprocesses of different articles overlap.
+"""
+import sys
+import Queue
+import threading
+
+def imap(func, items, workers, queueSize=None):
+    """
+    Yield func(n, item) for each item, in the order of items.  The calls
+    run on workers threads, and n is the number of the thread making the
+    call.  items is read lazily by a feeder thread, so it can itself be
+    the output of another stage.  No more than queueSize items (default
+    twice the number of workers) are in flight at once, counting those
+    finished but waiting for an earlier item to be yielded, so one slow
+    item stalls the feeder rather than filling memory.
+    An exception raised by func or by items is re-raised here.  If the
+    caller stops early, the threads finish the calls already under way
+    and exit once the generator is closed.  items is not closed, so a
+    caller chaining stages should close each of them, last stage first.
+    """
+
+    queueSize = queueSize or 2*workers
+    jobs = Queue.Queue(queueSize)
+    done = Queue.Queue(queueSize)
+    # a semaphore of queueSize slots, taken by the feeder for each item
+    # and given back as the item is yielded.  A queue of tokens, since
+    # the feeder has to wait with a timeout.
+    slots = Queue.Queue(queueSize)
+    feedError = []
+    stop = threading.Event()
+
+    # the threads wait with a timeout so they notice when the consumer
+    # has gone away and don't hang around blocked on a queue
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(queue):
+        while not stop.is_set():
+            try:
+                return queue.get(True, 0.1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def feed():
+        try:
+            for job in enumerate(items):
+                if not put(slots, None) or not put(jobs, job):
+                    return
+        except Exception:
+            feedError.append(sys.exc_info())
+        for n in range(workers):
+            put(jobs, None)
+
+    def work(n):
+        while True:
+            job = get(jobs)
+            if job is None:
+                put(done, None)
+                return
+            i, item = job
+            try:
+                result = (i, func(n, item), None)
+            except Exception:
+                result = (i, None, sys.exc_info())
+            if not put(done, result):
+                return
+
+    threads = [threading.Thread(target=feed)]
+    threads += [threading.Thread(target=work, args=(n,)) for n in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = {}
+    wanted = 0
+    finished = 0
+    try:
+        while finished < workers:
+            result = done.get()
+            if result is None:
+                finished += 1
+                continue
+            pending[result[0]] = result
+            while wanted in pending:
+                i, value, error = pending.pop(wanted)
+                slots.get_nowait()
+                if error:
+                    raise error[0], error[1], error[2]
+                yield value
+                wanted += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if feedError:
+        error = feedError[0]
+        raise error[0], error[1], error[2]
@@ -11,7 +11,7 @@ setup(name='encoDHer',
       description='symmetric email encryption utility for python',
       author='David R. Andersen',
       url='https://github.com/rxcomm/encoDHer',
-      py_modules=['encodher','dhutils','dh','constants','hsub'],
+      py_modules=['encodher','dhutils','dh','dhgroup','dhbackend','agent','nntppool','pipeline','spool','sink','constants','hsub'],
       install_requires=['python-gnupg >= 0.3.5'],
      )
 
@@ -23,6 +23,13 @@ with zipfile.ZipFile('encodher', 'w', zipfile.ZIP_DEFLATED) as z:
     z.write('dh_m2crypto.py')
     z.write('dh_pydhe.py')
     z.write('dh_legacy.py')
+    z.write('dhgroup.py')
+    z.write('dhbackend.py')
+    z.write('agent.py')
+    z.write('nntppool.py')
+    z.write('pipeline.py')
+    z.write('spool.py')
+    z.write('sink.py')
     z.write('hsub.py')
 
 with open('encodher', 'r+') as z:
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+encoDHer - a python package for symmetric encryption of email
+using the Diffie-Hellman shared secret key protocol.
+
+Copyright (C) 2013 by David R. Andersen
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, see https://github.com/rxcomm/encoDHer
+
+Where --fetch-aam, --poll-aam and --rescan-spool store the messages
+they decrypt: one file per message, a maildir, or an mbox.  Messages
+are stored still encrypted, as the a.a.m article with an
+X-encoDHer-Route header in front, so --decode-email can decrypt them
+later.  Sinks are only written from one thread.
+"""
+import os
+import re
+import time
+import fcntl
+import socket
+from constants import *
+
+def routeHeader(passphrase):
+    return 'X-encoDHer-Route: '+passphrase[1]+'->'+passphrase[0]+'\n'
+
+def writeFile(file_name, text, tmp_name):
+    """
+    Write text to tmp_name and rename it to file_name once it is on
+    disk, so a reader never sees half a message.
+    """
+
+    fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_name, file_name)
+    except:
+        os.unlink(tmp_name)
+        raise
+
+class FileSink(object):
+    """
+    One message_<Message-ID>.txt file per message in messageDir
+    """
+
+    kind = 'file'
+
+    def __init__(self, messageDir=''):
+        self.messageDir = messageDir
+        self.count = 0
+
+    def add(self, passphrase, message_id, text):
+        self.count += 1
+        name = 'message_'+re.sub(r'[^\w.@-]', '_', message_id.strip('<>'))+'.txt'
+        file_name = os.path.join(self.messageDir, name)
+        # unique per process and message, so a tmp file left behind by a
+        # killed process doesn't block the message for good
+        writeFile(file_name, routeHeader(passphrase)+text,
+                  os.path.join(self.messageDir, '.%s.%dQ%d.tmp' % (name, os.getpid(), self.count)))
+        return file_name
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class MaildirSink(object):
+    """
+    A maildir: each message is written to tmp/ and renamed into new/
+    """
+
+    kind = 'maildir'
+
+    def __init__(self, path=MAILBOX):
+        self.path = path
+        for sub in ('tmp', 'new', 'cur'):
+            if not os.path.exists(os.path.join(path, sub)):
+                os.makedirs(os.path.join(path, sub), 0700)
+        self.count = 0
+
+    def add(self, passphrase, message_id, text):
+        self.count += 1
+        name = '%d.P%dQ%d.%s' % (time.time(), os.getpid(), self.count,
+                                 socket.gethostname().replace('/', '_').replace(':', '_'))
+        file_name = os.path.join(self.path, 'new', name)
+        writeFile(file_name, routeHeader(passphrase)+text,
+                  os.path.join(self.path, 'tmp', name))
+        return file_name
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class MboxSink(object):
+    """
+    An mbox file.  It is locked while messages are being added, and
+    synced to disk every sync messages and on flush, rather than after
+    every message.
+    """
+
+    kind = 'mbox'
+
+    def __init__(self, path=MAILBOX, sync=MBOX_SYNC):
+        self.path = path
+        self.sync = sync
+        self.f = None
+        self.pending = 0
+
+    def add(self, passphrase, message_id, text):
+        if self.f is None:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            self.f = os.fdopen(fd, 'a')
+            fcntl.lockf(self.f, fcntl.LOCK_EX)
+        text = re.sub(r'(?m)^(>*From )', r'>\1', routeHeader(passphrase)+text)
+        self.f.write('From encodher '+time.asctime()+'\n'+text.rstrip('\n')+'\n\n')
+        self.pending += 1
+        if self.pending >= self.sync:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.pending = 0
+        return self.path
+
+    def flush(self):
+        """
+        Sync and unlock the mbox, e.g. between two polls
+        """
+
+        if self.f is not None:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            fcntl.lockf(self.f, fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+
+def openSink(kind=SINK, messageDir=''):
+    """
+    Return the sink for kind ('file', 'maildir' or 'mbox').  Files go
+    in messageDir, mailboxes in MAILBOX.
+    """
+
+    if kind == 'maildir':
+        return MaildirSink()
+    elif kind == 'mbox':
+        return MboxSink()
+    elif kind == 'file':
+        return FileSink(messageDir)
+    raise ValueError('unknown message sink: %s' % kind)
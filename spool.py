@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+encoDHer - a python package for symmetric encryption of email
+using the Diffie-Hellman shared secret key protocol.
+
+Copyright (C) 2013 by David R. Andersen
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+For more information, see https://github.com/rxcomm/encoDHer
+
+The local article spool.  With SPOOL set, --fetch-aam keeps a zlib
+compressed copy of every article it scans, so --rescan-spool can look
+for messages on a new or changed route without the news server.  The
+spool only holds articles that anyone can read from the newsgroup, so
+unlike keys.db it is not encrypted.
+"""
+import os
+import time
+import zlib
+import email
+import email.utils
+import sqlite3
+from constants import *
+
+class Spool(object):
+
+    def __init__(self, path=SPOOL_DB):
+        self.db = sqlite3.connect(path)
+        os.chmod(path, 0600)
+        with self.db:
+            cur = self.db.cursor()
+            cur.execute('CREATE TABLE IF NOT EXISTS articles (MessageId TEXT PRIMARY KEY, Server TEXT, NewsGroup TEXT, Number INTEGER, Subject TEXT, Date FLOAT, Size INTEGER, Article BLOB)')
+            cur.execute('CREATE INDEX IF NOT EXISTS articles_date ON articles (Date)')
+            cur.execute('CREATE INDEX IF NOT EXISTS articles_number ON articles (Server, NewsGroup, Number)')
+
+    def has(self, messageIds):
+        """
+        return the set of Message-IDs in messageIds that are spooled
+        """
+        cur = self.db.cursor()
+        spooled = set()
+        for messageId in messageIds:
+            cur.execute('SELECT 1 FROM articles WHERE MessageId = ?', (messageId,))
+            if cur.fetchone():
+                spooled.add(messageId)
+        return spooled
+
+    def add(self, server, group, number, messageId, lines):
+        """
+        Spool an article, given as the list of lines nntplib returns
+        """
+        text = '\n'.join(lines)
+        headers = email.message_from_string(text)
+        date = email.utils.parsedate_tz(headers.get('Date', ''))
+        date = email.utils.mktime_tz(date) if date else time.time()
+        article = zlib.compress(text, 9)
+        with self.db:
+            self.db.cursor().execute('INSERT OR REPLACE INTO articles (MessageId, Server, NewsGroup, Number, Subject, Date, Size, Article) VALUES(?,?,?,?,?,?,?,?)',
+                                     (messageId, server, group, int(number), headers.get('Subject', ''),
+                                      date, len(article), buffer(article)))
+
+    def get(self, messageId):
+        """
+        return a spooled article as a list of lines, or None
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT Article FROM articles WHERE MessageId = ?', (messageId,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(str(row[0])).split('\n')
+
+    def subjects(self, since=None):
+        """
+        return (article number, Message-ID, Subject) for the spooled
+        articles, oldest first, optionally only those dated since then
+        """
+        cur = self.db.cursor()
+        cur.execute('SELECT Number, MessageId, Subject FROM articles WHERE Date >= ? ORDER BY Date, Number',
+                    (since or 0,))
+        return cur.fetchall()
+
+    def expire(self, days=SPOOL_DAYS, maxBytes=SPOOL_MAX_MB*1024*1024):
+        """
+        Drop articles more than days old, then the oldest articles until
+        the spool holds no more than maxBytes of compressed articles.
+        Returns the number of articles dropped.
+        """
+        with self.db:
+            cur = self.db.cursor()
+            cur.execute('DELETE FROM articles WHERE Date < ?', (time.time()-days*86400,))
+            dropped = cur.rowcount
+            total = 0
+            cur.execute('SELECT Date, Size FROM articles ORDER BY Date DESC')
+            for date, size in cur.fetchall():
+                total += size
+                if total > maxBytes:
+                    cur.execute('DELETE FROM articles WHERE Date <= ?', (date,))
+                    dropped += cur.rowcount
+                    break
+        return dropped
+
+    def close(self):
+        self.db.close()